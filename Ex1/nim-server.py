@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
+import os
+import signal
 import socket
+import struct
 import sys
+import traceback
+from select import select
 
 from nim_helper import *
 from nim_constants import *
@@ -123,16 +128,94 @@ class NimServer:
 			if not res:
 				break
 
+	def listen(self):
+		listen_soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listen_soc.bind(('', self.port))
+		listen_soc.listen()
+		return listen_soc
+
+	# accept clients and play their games one after the other.
+	# stop after max_games games (None for no limit), report_fd is written a packet per finished game
+	def serve(self, listen_soc, max_games=None, report_fd=None):
+		games = 0
+		while max_games is None or games < max_games:
+			(self.client_conn, address) = listen_soc.accept()
+			print("Accepted new connection from", address)
+			self.start_game()
+			self.client_conn.close()
+			print("Closed connection with the client")
+			games += 1
+			if report_fd is not None:
+				os.write(report_fd, struct.pack(WORKER_REPORT_STRUCT, os.getpid()))
+
 	def start(self):
-		with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listen_soc:
-			listen_soc.bind(('', self.port))
-			listen_soc.listen()
-			while True:
-				(self.client_conn, address) = listen_soc.accept()
-				print("Accepted new connection from", address)
-				self.start_game()
-				self.client_conn.close()
-				print("Closed connection with the client")
+		with self.listen() as listen_soc:
+			self.serve(listen_soc)
+
+	# fork a worker serving games on the shared listening socket. return its pid
+	def fork_worker(self, listen_soc, max_games, report_fd):
+		sys.stdout.flush()   # do not let the worker inherit buffered output
+		pid = os.fork()
+		if pid != 0:
+			return pid
+		# the parent stops the workers, ignore the terminal's ctrl-c
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		try:
+			self.serve(listen_soc, max_games, report_fd)
+		except BaseException:
+			# never return into the parent's loop, report the crash through the exit status
+			traceback.print_exc()
+			sys.stderr.flush()
+			os._exit(1)
+		os._exit(0)
+
+	# pre-fork mode: num_workers processes run the blocking game loop on the same listening socket.
+	# the parent keeps the pool at size, replacing workers that exit (after max_games games)
+	def start_prefork(self, num_workers, max_games):
+		report_recv_fd, report_send_fd = os.pipe()
+		os.set_blocking(report_recv_fd, False)
+		worker_games = {}      # map worker pid to the number of games it finished
+		with self.listen() as listen_soc:
+			try:
+				while True:
+					while len(worker_games) < num_workers:
+						pid = self.fork_worker(listen_soc, max_games, report_send_fd)
+						worker_games[pid] = 0
+						print(f"Started worker {pid}")
+
+					select([report_recv_fd], [], [], WORKER_REAP_INTERVAL)
+					self.read_worker_reports(report_recv_fd, worker_games)
+					self.reap_workers(worker_games)
+			except KeyboardInterrupt:
+				for pid in worker_games:
+					os.kill(pid, signal.SIGTERM)
+				self.print_worker_games(worker_games)
+
+	# count the games the workers reported finishing
+	def read_worker_reports(self, report_fd, worker_games):
+		while True:
+			try:
+				reports = os.read(report_fd, WORKER_REPORT_SIZE * 256)
+			except BlockingIOError:
+				return
+			for (pid,) in struct.iter_unpack(WORKER_REPORT_STRUCT, reports):
+				if pid in worker_games:
+					worker_games[pid] += 1
+
+	# forget workers that exited and report their game counts
+	def reap_workers(self, worker_games):
+		while worker_games:
+			pid, status = os.waitpid(-1, os.WNOHANG)
+			if pid == 0:
+				return
+			if pid in worker_games and os.waitstatus_to_exitcode(status) != 0:
+				print(f"Worker {pid} crashed after {worker_games.pop(pid)} games")
+			elif pid in worker_games:
+				print(f"Worker {pid} exited after {worker_games.pop(pid)} games")
+
+	def print_worker_games(self, worker_games):
+		for pid, games in worker_games.items():
+			print(f"Worker {pid}: {games} games")
 
 
 def check_legal_move(move):
@@ -155,20 +238,56 @@ def validate_input(args):
 		print('Heaps sizes should be numbers between 1 to 1000')
 		exit()
 
-	if len(args) == 4 and not args[3].isdigit():
+	# the port is optional, flags may follow the heaps directly
+	positional = get_positional_args(args)
+	if len(positional) > BOARD_SIZE + 1:
+		print('Invalid number of arguments')
+		exit()
+
+	if len(positional) == BOARD_SIZE + 1 and not positional[BOARD_SIZE].isdigit():
 		print('Port should be a positive number')
 		exit()
 
+	for arg in args[len(positional):]:
+		name, _, value = arg.partition('=')
+		if name not in ['--workers', '--max-games'] or not value.isdigit() or int(value) < 1:
+			print('Invalid flags')
+			exit()
+
 	return True
 
+# return the arguments before the first --flag
+def get_positional_args(args):
+	for i, arg in enumerate(args):
+		if arg.startswith('--'):
+			return args[:i]
+	return args
+
+# return the value of a --name=value flag, or <default> if it was not given
+def get_flag_value(args, name, default=None):
+	for arg in args:
+		if arg.startswith(name + '='):
+			return arg.split('=', 1)[1]
+	return default
+
 def main():
 	args = sys.argv[1:]
 	validate_input(args)
 
-	board = list(map(int, args[:BOARD_SIZE]))
-	port = int(args[BOARD_SIZE]) if (len(args) == BOARD_SIZE + 1) else SERVER_DEFAULT_PORT
+	positional = get_positional_args(args)
+	board = list(map(int, positional[:BOARD_SIZE]))
+	port = int(positional[BOARD_SIZE]) if (len(positional) >= BOARD_SIZE + 1) else SERVER_DEFAULT_PORT
+	workers = get_flag_value(args, '--workers')
+	max_games = get_flag_value(args, '--max-games')
+
 	nim_server = NimServer(board, port)
-	nim_server.start()
+	if workers is None:
+		nim_server.start()
+	elif not hasattr(os, 'fork'):
+		print('Pre-fork mode is not supported on this platform')
+		exit()
+	else:
+		nim_server.start_prefork(int(workers), int(max_games) if max_games else None)
 
 
 if __name__ == "__main__":
@@ -7,6 +7,10 @@ NONE = -1  # used as null argument
 SERVER_DEFAULT_HOSTNAME = 'localhost'
 SERVER_DEFAULT_PORT = 6444
 
+WORKER_REPORT_STRUCT = ">i"   # pre-fork workers report every finished game with their pid
+WORKER_REPORT_SIZE = 4
+WORKER_REAP_INTERVAL = 1      # seconds between checks for exited workers
+
 BOARD_SIZE = 3
 
 PACKET_SIZE = 8         # size of packet structure
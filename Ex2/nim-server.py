@@ -1,19 +1,35 @@
 #!/usr/bin/env python3
 
+import os
+import secrets
 import socket
+import stat
 import sys
+import time
 import functools
+import multiprocessing
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from select import select
 
 from nim_helper import *
 from nim_constants import *
+from nim_solver import NimRules, NimSolver
+from nim_search import SearchStrategy, SEARCH_DEFAULT_BUDGET, SEARCH_DIFFICULTIES
+from nim_spectator import SpectatorQueue
+from nim_stateless import (StateTokenCodec, ReplayCache, InvalidStateToken, new_game_id, load_state_key,
+							encode_stateless_response, STATE_TOKEN_SIZE, STATELESS_REQUEST_SIZE)
+from nim_admin import AdminConnection
+from nim_udp import (UdpSession, encode_udp_packet, seq_after, UDP_PACKET_STRUCT, UDP_PACKET_SIZE, UDP_MAX_DATAGRAM_SIZE, UDP_HEADER_SIZE,
+					 UDP_SESSION_TIMEOUT, UDP_BATCH_MAX)
 
 
 
 class Game:
-	def __init__(self, board):
+	def __init__(self, board, rules=None):
 		self.board = board.copy()
+		self.rules = rules or NimRules()
 		self.done = False
 		self.turn = ARG_CLIENT
 
@@ -25,7 +41,7 @@ class Game:
 	def validate_move(self, heap, num):
 		if heap >= len(self.board) or heap < 0 or num > self.board[heap] or num < 0:
 			return False
-		return True
+		return num == 0 or self.rules.allows(num)
 
 	# execute game move
 	def move(self, heap, num):
@@ -40,9 +56,10 @@ class Game:
 	def get_board_status(self):
 		return self.board.copy()
 
+	# the player who took the last item wins, unless playing misere
 	def get_winner(self):
 		if self.done:
-			return self.get_next_turn()
+			return self.turn if self.rules.misere else self.get_next_turn()
 		return -1
 
 	def get_next_turn(self):
@@ -51,9 +68,19 @@ class Game:
 # serves a single client connection - handles client requests 
 class NimGameHost:
 
-	def __init__(self, board, strategy):
+	def __init__(self, board, strategy, rules=None, game_id=NONE):
 		self.strategy = strategy
-		self.game = Game(board)
+		self.game = Game(board, rules)
+		self.game_id = game_id
+		self.resume_token = None    # token a reconnecting client presents to continue the game, None on the legacy port
+		self.last_seq = None        # sequence number of the last request, on the udp transport
+		self.last_response = None   # response to that request, resent when it is retransmitted
+
+	# Send packet telling the client its game started, with the game id, followed by the resume token
+	# if the game has one
+	def send_start_response(self):
+		resp = encode_response(OP_START, [self.game_id])
+		return resp + self.resume_token if self.resume_token else resp
 
 	# Send packet to client informing about a winner.
 	# return encoded winner response 
@@ -80,11 +107,12 @@ class NimGameHost:
 		else:
 			return self.send_board_state_response()
 
-	# Server executes its next move
-	def execute_server_move(self):
+	# Server executes its next move. <server_move> is a move computed ahead of time
+	# (by a search offloaded to a process pool), otherwise the strategy is called
+	def execute_server_move(self, server_move=None):
 		assert not self.game.is_done()
 		board = self.game.get_board_status()
-		move, num = self.strategy(board)
+		move, num = server_move or self.strategy(board)
 		self.game.move(move, num)
 
 	# Execute move request from client and return proper response (valid / illegal move)
@@ -99,6 +127,15 @@ class NimGameHost:
 			self.execute_server_move()
 		return resp
 
+	# return True iff a request with sequence number <seq> was already executed (a retransmission
+	# or an outdated duplicate), otherwise remember it as the request being executed
+	def is_duplicate_request(self, seq):
+		if not seq_after(seq, self.last_seq):
+			return True
+		self.last_seq = seq
+		self.last_response = None
+		return False
+
 	# Route client request to appropriate method and return the response
 	def execute_command(self, op, args):
 			if op == OP_MOVE:
@@ -115,30 +152,225 @@ class NimServerMultiplexing:
 				 port,
 				 num_players,
 				 wait_list_size,
-				 strategy):
+				 strategy,
+				 rules=None,
+				 search_workers=None,
+				 session_port=None,
+				 output_watermarks=(OUTPUT_LOW_WATERMARK, OUTPUT_HIGH_WATERMARK),
+				 backlog=SERVER_DEFAULT_BACKLOG,
+				 nonblocking_accept=False,
+				 stateless_port=None,
+				 state_codec=None,
+				 udp_port=None,
+				 admin_path=None,
+				 strategies=None):
 		self.initial_board = board
 		self.port = port
+		self.backlog = backlog         # listen backlog of the listening sockets
+		self.nonblocking_accept = nonblocking_accept   # make accepted sockets non-blocking
+		self.session_port = session_port   # port of the session protocol, None if disabled
+		self.stateless_port = stateless_port   # port of the stateless protocol, None if disabled
+		self.state_codec = state_codec     # signs and verifies the state tokens of stateless games
+		self.replay_cache = ReplayCache()  # state tokens consumed on this server
+		self.stateless_connections = set() # sockets connected to the stateless port
+		self.udp_port = udp_port           # port of the udp transport, None if disabled
+		self.udp_soc = None
+		self.udp_sessions = {}             # map (client address, session id) to its UdpSession
 		self.num_players = num_players
 		self.wait_list_size = wait_list_size
 		self.strategy = strategy       # servers nim playing strategy
-		self.active_players = []       # list of sockets playing 
-		self.waiting_queue = []        # list of sockets in waiting queue
+		self.strategies = strategies or {}  # map name to a strategy the admin channel can switch to
+		self.rules = rules             # nim variant played, None for normal nim
+		# a player is a socket, or a (socket, session id) pair for games played on the session port
+		self.active_players = []       # list of players playing 
+		self.waiting_queue = []        # list of players in waiting queue
 		self.rejected_players = []     # list of sockets we need to reject 
-		self.soc_to_game_host = {}     # map active socket to its running game host
+		self.player_to_game_host = {}  # map active player to its running game host
+		self.soc_to_sessions = {}      # map session port socket to the session ids it opened
+		self.spectators = {}           # map spectating socket to its queue of game updates
+		self.next_game_id = 1
+		self.resume_tokens = {}        # map resume token of a running game to its player
+		self.suspended_games = OrderedDict()  # map resume token to (game host, expiry) of a disconnected player's game
+		# output flow control: sockets over the high watermark are not read until below the low watermark
+		self.output_low_watermark, self.output_high_watermark = output_watermarks
+		self.paused_sockets = set()    # sockets not read because their output buffer is over the high watermark
+		self.paused_since = {}         # map paused socket to the time it was paused
+		self.stats = {'pauses': 0, 'dropped_connections': 0, 'resumed_games': 0}
 		self.soc_to_msg_recv = {}      # current packet chunk we received in each socket
 		self.soc_to_msg_send = {}      # remaining packet chunk to send for every socket
+		self.pending_moves = {}        # map player to (future, deadline, response) of a server move being searched
+		self.deferred_packets = {}     # map session player to packets received while its server move is searched
+		self.search_pool = None        # process pool running search strategies, created with the first one
+		self.search_workers = search_workers
+		self.set_strategy(strategy)
+		# pool workers wake the event loop up by writing to this socket pair
+		self.wakeup_recv_soc, self.wakeup_send_soc = socket.socketpair()
+		self.listeners = {}            # map listening socket to the handler of its new connections
+		self.admin_path = admin_path   # path of the admin unix socket, None if disabled
+		self.admin_soc = None
+		self.admin_connections = {}    # map admin socket to its AdminConnection
+		self.draining = False          # no new games are admitted, the server exits once the running ones end
+
+	# play new games with strategy
+	def set_strategy(self, strategy):
+		if isinstance(strategy, SearchStrategy) and self.search_pool is None:
+			self.search_pool = ProcessPoolExecutor(self.search_workers, mp_context=multiprocessing.get_context('spawn'))
+		self.strategy = strategy
+
+	# return the players of a connection
+	def get_connection_players(self, soc):
+		if soc in self.soc_to_sessions:
+			return [(soc, session_id) for session_id in self.soc_to_sessions[soc]]
+		return [soc]
+
+	# add an encoded response to the write buffer of the player's socket
+	def send_to_player(self, player, resp):
+		if isinstance(player, UdpSession):
+			self.send_to_udp_session(player, resp)
+			return
+		if isinstance(player, tuple):
+			soc, session_id = player
+			self.soc_to_msg_send[soc] += encode_session_packet(session_id, resp)
+		else:
+			soc = player
+			self.soc_to_msg_send[soc] += resp
+		self.update_flow_control(soc)
+
+	# pause or resume reading from socket according to the size of its output buffer
+	def update_flow_control(self, soc):
+		size = len(self.soc_to_msg_send[soc])
+		if soc not in self.paused_sockets and size >= self.output_high_watermark:
+			self.paused_sockets.add(soc)
+			self.paused_since[soc] = time.monotonic()
+			self.stats['pauses'] += 1
+		elif soc in self.paused_sockets and size <= self.output_low_watermark:
+			self.paused_sockets.remove(soc)
+			self.paused_since.pop(soc)
+
+	# close connections that did not read their responses for too long. a paused socket is not
+	# read, so its output buffer stops growing near the high watermark and it is timed from its pause
+	def close_stalled_connections(self):
+		now = time.monotonic()
+		for soc, since in list(self.paused_since.items()):
+			if now - since >= OUTPUT_STALL_TIMEOUT:
+				print("[debug] closing connection that does not read its responses")
+				self.stats['dropped_connections'] += 1
+				self.close_connection(soc)
+
+	# return counters describing the server's load
+	def get_stats(self):
+		return {
+			'connections': len(self.soc_to_msg_send),
+			'active_players': len(self.active_players),
+			'waiting_players': len(self.waiting_queue),
+			'spectators': len(self.spectators),
+			'paused_connections': len(self.paused_sockets),
+			'pauses': self.stats['pauses'],
+			'dropped_connections': self.stats['dropped_connections'],
+			'num_players': self.num_players,
+			'wait_list_size': self.wait_list_size,
+			'draining': int(self.draining),
+			'suspended_games': len(self.suspended_games),
+			'resumed_games': self.stats['resumed_games'],
+		}
+
+	# remove player from every list(if exists). the game of a player that disconnected or timed out
+	# is suspended until it resumes it, a game the player closed is not. also start a new game for a waiting player
+	def close_player(self, player, suspend=False):
+		if player in self.pending_moves:
+			self.pending_moves.pop(player)[0].cancel()
+			if suspend:
+				# the client's move was played, play the server's so the game resumes on the client's turn
+				game_host = self.player_to_game_host[player]
+				game_host.execute_server_move(game_host.strategy.fallback(game_host.game.get_board_status()))
+		self.deferred_packets.pop(player, None)
+
+		if player in self.active_players:
+			self.active_players.remove(player)
+			game_host = self.player_to_game_host.pop(player)
+			self.resume_tokens.pop(game_host.resume_token, None)
+			if suspend:
+				self.suspend_game(game_host)
+			self.promote_waiting_players()
+
+		if player in self.waiting_queue:
+			self.waiting_queue.remove(player)
+
+	# keep the game of a disconnected player until RESUME_TTL passes. a game without moves or
+	# already over is not worth resuming, a game of the legacy port has no token to resume it with
+	def suspend_game(self, game_host):
+		if game_host.resume_token is None or game_host.game.is_done() or game_host.game.get_board_status() == self.initial_board:
+			return
+		self.expire_suspended_games()
+		if len(self.suspended_games) >= RESUME_CACHE_SIZE:
+			self.suspended_games.popitem(last=False)
+		self.suspended_games[game_host.resume_token] = (game_host, time.monotonic() + RESUME_TTL)
+
+	# drop the suspended games whose player did not come back in time
+	def expire_suspended_games(self):
+		now = time.monotonic()
+		while self.suspended_games and next(iter(self.suspended_games.values()))[1] < now:
+			self.suspended_games.popitem(last=False)
+
+	# return an unused resume token
+	def new_resume_token(self):
+		while True:
+			token = secrets.token_bytes(RESUME_TOKEN_SIZE)
+			if token not in self.resume_tokens and token not in self.suspended_games:
+				return token
+
+	# return the game of a resume token and game id, or None if there is none or it expired. a game still
+	# played is taken over from its player, whose connection may be half open after a network failure
+	# the server did not notice. tokens are RESUME_TOKEN_SIZE random bytes, so they can not be guessed
+	def take_resumable_game(self, token, game_id):
+		self.expire_suspended_games()
+		entry = self.suspended_games.get(token)
+		if entry is not None and entry[0].game_id == game_id:
+			return self.suspended_games.pop(token)[0]
+
+		player = self.resume_tokens.get(token)
+		if player is None or self.player_to_game_host[player].game_id != game_id:
+			return None
+		game_host = self.player_to_game_host[player]
+		self.drop_session(player)
+		self.suspended_games.pop(token, None)
+		return game_host
+
+	# end a session whose game was taken over. its game is suspended, so a pending server move is played
+	def drop_session(self, player):
+		print("[debug] resumed game taken over from its session")
+		self.close_player(player, suspend=True)
+		if isinstance(player, UdpSession):
+			self.udp_sessions.pop((player.addr, player.session_id))
+		else:
+			self.soc_to_sessions[player[0]].discard(player[1])
+
+	# continue the game of the resume token and game id on a new session, or reject the session
+	def handle_resume_request(self, player, args, token):
+		game_host = self.take_resumable_game(token, args[0])
+		if game_host is None:
+			self.client_reject(player, [ARG_TOKEN_INVALID])
+			return
+		self.client_resume(player, game_host)
+
+	# start games for waiting players while there is room for them
+	def promote_waiting_players(self):
+		while self.waiting_queue and len(self.active_players) < self.num_players:
+			self.client_start(self.waiting_queue.pop(0))
 
 	# remove socket from every list(if exists) and close connection.
-	# also start a new game for a waiting socket
+	# also start new games for waiting players
 	def close_connection(self, client_soc):
-		if client_soc in self.active_players:
-			self.active_players.remove(client_soc)
-			self.soc_to_game_host.pop(client_soc)
-			if len(self.waiting_queue) > 0:
-				self.client_start(self.waiting_queue.pop(0))
+		for player in self.get_connection_players(client_soc):
+			self.close_player(player, suspend=True)
+
+		if client_soc in self.soc_to_sessions:
+			self.soc_to_sessions.pop(client_soc)
+
+		if client_soc in self.spectators:
+			self.spectators.pop(client_soc)
 
-		if client_soc in self.waiting_queue:
-			self.waiting_queue.remove(client_soc)
+		self.stateless_connections.discard(client_soc)
 
 		if client_soc in self.rejected_players:
 			self.rejected_players.remove(client_soc)
@@ -148,34 +380,282 @@ class NimServerMultiplexing:
 
 		if client_soc in self.soc_to_msg_send:
 			self.soc_to_msg_send.pop(client_soc)
+
+		self.paused_sockets.discard(client_soc)
+		self.paused_since.pop(client_soc, None)
 			
 		client_soc.close()
 
-	# parse packet into command, execute it and add response to write buffer of socket
-	def handle_active_player_packet(self, soc, packet_bytes):		
+	# send a datagram answering the request being handled, and cache it for retransmissions.
+	# before its game starts a session answers its last admission request
+	def send_to_udp_session(self, session, resp):
+		game_host = self.player_to_game_host.get(session)
+		if game_host is not None and game_host.last_seq is not None:
+			game_host.last_response = resp
+			seq = game_host.last_seq
+		else:
+			seq = session.seq
+		self.send_udp_datagram(encode_udp_packet(session.session_id, seq, resp), session.addr)
+
+	def send_udp_datagram(self, datagram, addr):
+		try:
+			self.udp_soc.sendto(datagram, addr)
+		except OSError:
+			pass  # the client retransmits its request
+
+	# handle a datagram received on the udp port
+	def handle_udp_datagram(self, datagram, addr):
+		if len(datagram) < UDP_PACKET_SIZE:
+			return
+		session_id, seq, op, *args = struct.unpack(UDP_PACKET_STRUCT, datagram[:UDP_PACKET_SIZE])
+		token = datagram[UDP_PACKET_SIZE:]
+		if len(token) != (RESUME_TOKEN_SIZE if op == OP_RESUME else 0):
+			return
+		key = (addr, session_id)
+		session = self.udp_sessions.get(key)
+
+		if session is None:
+			if op in (OP_SESSION_OPEN, OP_RESUME):
+				session = UdpSession(addr, session_id, seq)
+				self.udp_sessions[key] = session
+				if op == OP_RESUME:
+					self.handle_resume_request(session, args, token)
+				else:
+					self.handle_new_player(session)
+			else:
+				# unknown (closed or expired) session, acknowledge a close and refuse the rest
+				resp_op = OP_SESSION_CLOSE if op == OP_SESSION_CLOSE else OP_REJECT
+				self.send_udp_datagram(encode_udp_packet(session_id, seq, encode_response(resp_op)), addr)
+			return
+
+		session.last_seen = time.monotonic()
+		game_host = self.player_to_game_host.get(session)
+		if op in (OP_SESSION_OPEN, OP_RESUME):
+			# retransmitted open or resume, or a waiting client polling for its start. answered under
+			# its own seq and not cached, the cached response belongs to the game's last request
+			session.seq = seq
+			resp = game_host.send_start_response() if game_host else encode_response(OP_WAIT)
+			self.send_udp_datagram(encode_udp_packet(session_id, seq, resp), addr)
+		elif op == OP_SESSION_CLOSE:
+			self.close_player(session)
+			self.udp_sessions.pop(key)
+			self.send_udp_datagram(encode_udp_packet(session_id, seq, encode_response(OP_SESSION_CLOSE)), addr)
+		elif game_host is not None and session not in self.pending_moves:
+			# requests arriving while the server's move is searched are retransmitted by the client
+			if game_host.is_duplicate_request(seq):
+				if seq == game_host.last_seq and game_host.last_response is not None:
+					self.send_to_player(session, game_host.last_response)
+				return
+			self.handle_active_player_packet(session, datagram[UDP_HEADER_SIZE:])
+
+	# read the datagrams waiting on the udp socket
+	def handle_udp_reads(self):
+		for _ in range(UDP_BATCH_MAX):
+			try:
+				datagram, addr = self.udp_soc.recvfrom(UDP_MAX_DATAGRAM_SIZE)
+			except (BlockingIOError, ConnectionError):
+				return
+			self.handle_udp_datagram(datagram, addr)
+
+	# drop udp sessions that stayed silent for too long
+	def expire_udp_sessions(self):
+		now = time.monotonic()
+		for key, session in list(self.udp_sessions.items()):
+			if now - session.last_seen >= UDP_SESSION_TIMEOUT:
+				print("[debug] udp session expired")
+				self.close_player(session, suspend=True)
+				self.udp_sessions.pop(key)
+
+	# parse packet into command, execute it and add response to write buffer of the player
+	def handle_active_player_packet(self, player, packet_bytes):		
 		op, *args = struct.unpack(PACKET_STRUCT, packet_bytes)
-		resp = self.soc_to_game_host[soc].execute_command(op, args)
-		self.soc_to_msg_send[soc] += resp
+		game_host = self.player_to_game_host[player]
+		if op == OP_MOVE and game_host.game.done:
+			# sessions outlive their game, a late move is answered with the game's result
+			self.send_to_player(player, game_host.send_winner_response())
+			return
+		if op == OP_MOVE and isinstance(game_host.strategy, SearchStrategy):
+			self.start_search_move(player, game_host, args)
+			return
+		if op not in (OP_MOVE, OP_GAME_STATE):
+			return
+		resp = game_host.execute_command(op, args)
+		self.send_to_player(player, resp)
+		if op == OP_MOVE:
+			self.publish_game(game_host)
+
+	# send the game's state to its spectators. the update is encoded once and shared by all queues
+	def publish_game(self, game_host):
+		if not self.spectators:
+			return
+		packet = None
+		for queue in self.spectators.values():
+			if queue.wants(game_host.game_id):
+				packet = packet or encode_session_packet(game_host.game_id, game_host.execute_game_state_request())
+				queue.push(game_host.game_id, packet)
+
+	# route a packet received on the session port to its session
+	def handle_session_packet(self, soc, packet_bytes):
+		session_id, op, *args = struct.unpack(SESSION_PACKET_STRUCT, packet_bytes[:SESSION_PACKET_SIZE])
+		player = (soc, session_id)
+		sessions = self.soc_to_sessions[soc]
+
+		# a connection either plays sessions or spectates, so their output never interleaves
+		if op == OP_SPECTATE:
+			if not sessions:
+				self.spectators.setdefault(soc, SpectatorQueue()).subscribe(args[0])
+				soc.setblocking(False)
+		elif soc in self.spectators:
+			return
+		elif op == OP_SESSION_OPEN:
+			if session_id != 0 and session_id not in sessions:
+				self.handle_new_player(player)
+		elif op == OP_RESUME:
+			if session_id != 0 and session_id not in sessions:
+				self.handle_resume_request(player, args, packet_bytes[SESSION_PACKET_SIZE:])
+		elif op == OP_SESSION_CLOSE:
+			if session_id in sessions:
+				self.close_player(player)
+				sessions.discard(session_id)
+		elif player in self.pending_moves:
+			# wait for the server's move before answering anything else on this session
+			self.deferred_packets.setdefault(player, []).append(packet_bytes[SESSION_PACKET_SIZE - PACKET_SIZE:])
+		elif player in self.player_to_game_host:
+			self.handle_active_player_packet(player, packet_bytes[SESSION_PACKET_SIZE - PACKET_SIZE:])
+
+	# handle a request of a stateless game: rebuild the game from the state token, play the
+	# requested move and answer with the new state and a new token. nothing is kept
+	def handle_stateless_packet(self, soc, packet_bytes):
+		op, *args = struct.unpack(PACKET_STRUCT, packet_bytes[:PACKET_SIZE])
+		try:
+			if op == OP_STATELESS_NEW:
+				game_id, seq, board, turn, expiry = new_game_id(), 0, self.initial_board, ARG_CLIENT, None
+			elif op in (OP_MOVE, OP_GAME_STATE):
+				game_id, seq, board, turn, expiry = self.state_codec.verify(packet_bytes[PACKET_SIZE:])
+			else:
+				raise InvalidStateToken(ARG_TOKEN_INVALID)
+			if op == OP_MOVE and sum(board) > 0 and not self.replay_cache.consume(game_id, seq, expiry):
+				raise InvalidStateToken(ARG_TOKEN_REPLAYED)
+		except InvalidStateToken as error:
+			self.send_to_player(soc, encode_stateless_response(OP_REJECT, error.reason, [NONE] * BOARD_SIZE, NONE, bytes(STATE_TOKEN_SIZE)))
+			return
+
+		validity = NONE
+		if sum(board) == 0:
+			# finished game, the token holds the winner
+			resp_op, board, turn = OP_GAME_DONE, [0] * BOARD_SIZE, turn
+		else:
+			# stateless games are played synchronously, search strategies play their fallback
+			strategy = self.strategy.fallback if isinstance(self.strategy, SearchStrategy) else self.strategy
+			game_host = NimGameHost(board, strategy, self.rules)
+			if op == OP_MOVE:
+				validity = struct.unpack(PACKET_STRUCT, game_host.execute_move_request(op, args))[1]
+				seq = (seq + 1) % 65536
+			board = game_host.game.get_board_status()
+			if game_host.game.done:
+				resp_op, turn = OP_GAME_DONE, game_host.game.get_winner()
+			else:
+				resp_op, turn = OP_GAME_ACTIVE, ARG_CLIENT
+
+		if op == OP_GAME_STATE:
+			# a state query hands back the token it was given. re-signing it would extend its expiry
+			# past the replay cache entry of a move made with it, so only a move issues a new token
+			token = packet_bytes[PACKET_SIZE:]
+		else:
+			token = self.state_codec.sign(game_id, seq, board, turn)
+		self.send_to_player(soc, encode_stateless_response(resp_op, validity, board, turn, token))
+
+	# execute the client's move and submit the server's reply move to the search pool.
+	# the response is held back until the server moved, and the player's packets are not handled meanwhile
+	def start_search_move(self, player, game_host, args):
+		resp = game_host.execute_client_move(args[0], args[1])
+		if game_host.game.is_done():
+			self.send_to_player(player, resp)
+			self.publish_game(game_host)
+			return
+		future, deadline = game_host.strategy.submit(self.search_pool, game_host.game.get_board_status())
+		future.add_done_callback(self.wake_up)
+		self.pending_moves[player] = (future, deadline, resp)
+
+	# called from the pool's management thread when a search finished
+	def wake_up(self, future):
+		try:
+			self.wakeup_send_soc.send(b'\0')
+		except OSError:
+			pass
+
+	# apply the server moves whose search finished, or whose deadline passed using the fallback move
+	def complete_search_moves(self):
+		now = time.monotonic()
+		for player, (future, deadline, resp) in list(self.pending_moves.items()):
+			if future.done():
+				move = None if future.cancelled() or future.exception() else future.result()
+			elif now >= deadline:
+				future.cancel()
+				move = None
+			else:
+				continue
+
+			self.pending_moves.pop(player)
+			game_host = self.player_to_game_host[player]
+			board = game_host.game.get_board_status()
+			if move is None or not game_host.game.validate_move(*move):
+				move = game_host.strategy.fallback(board)
+			game_host.execute_server_move(move)
+			self.send_to_player(player, resp)
+			self.publish_game(game_host)
+
+			# handle packets of the session that arrived during the search
+			deferred = self.deferred_packets.pop(player, [])
+			while deferred and player not in self.pending_moves:
+				self.handle_active_player_packet(player, deferred.pop(0))
+			if deferred:
+				self.deferred_packets[player] = deferred
+
+	# seconds until the closest search or stall deadline, None if there is none
+	def get_select_timeout(self):
+		deadlines = [deadline for _, deadline, _ in self.pending_moves.values()]
+		deadlines += [since + OUTPUT_STALL_TIMEOUT for since in self.paused_since.values()]
+		deadlines += [session.last_seen + UDP_SESSION_TIMEOUT for session in self.udp_sessions.values()]
+		if not deadlines:
+			return None
+		return max(min(deadlines) - time.monotonic(), 0)
+
+	# return size of the packets read from socket
+	def get_packet_size(self, soc):
+		if soc in self.soc_to_sessions:
+			return get_session_packet_size(self.soc_to_msg_recv[soc])
+		if soc in self.stateless_connections:
+			return STATELESS_REQUEST_SIZE
+		return PACKET_SIZE
 
 	# handle reads of all readable sockets
 	def handle_reads(self, Readable):
-		# for every readable socket, we attempt to read the remaining number of bytes to complete a full 4 byte packet
+		# for every readable socket, we attempt to read the remaining number of bytes to complete a full packet
 		# if failed, close connection otherwise update remaining number of bytes to read
 		# and if a packet was completed, execute it otherwise continue
 		for soc in Readable:
-			msg = recv(soc, PACKET_SIZE - len(self.soc_to_msg_recv[soc]))
+			packet_size = self.get_packet_size(soc)
+			msg = recv(soc, packet_size - len(self.soc_to_msg_recv[soc]))
+			if msg is None:
+				continue
 			if len(msg) == 0:
 				self.close_connection(soc)
 				return
 
 			self.soc_to_msg_recv[soc] += msg
-			if len(self.soc_to_msg_recv[soc]) < PACKET_SIZE:
+			packet_size = self.get_packet_size(soc)   # grows once a session packet shows it carries a token
+			if len(self.soc_to_msg_recv[soc]) < packet_size:
 				continue
 			
 			# handle full packet
-			if soc in self.active_players:
+			if soc in self.soc_to_sessions:
+				self.handle_session_packet(soc, self.soc_to_msg_recv[soc])
+			elif soc in self.stateless_connections:
+				self.handle_stateless_packet(soc, self.soc_to_msg_recv[soc])
+			elif soc in self.active_players:
 				self.handle_active_player_packet(soc, self.soc_to_msg_recv[soc])
-				self.soc_to_msg_recv[soc] = self.soc_to_msg_recv[soc][PACKET_SIZE:]
+			self.soc_to_msg_recv[soc] = self.soc_to_msg_recv[soc][packet_size:]
 
 	# handle writes to all writable sockets
 	def handle_writes(self, Writable):
@@ -195,57 +675,290 @@ class NimServerMultiplexing:
 			self.soc_to_msg_send[soc] = msg[size:]
 			if len(self.soc_to_msg_send[soc]) == 0 and soc in self.rejected_players:
 				self.close_connection(soc)
+			else:
+				self.update_flow_control(soc)
+
+	# handle writes to writable spectators, after the players were served
+	def handle_spectator_writes(self, Writable):
+		for soc in Writable:
+			if self.spectators[soc].send(soc) == -1:
+				self.close_connection(soc)
 						
 
 	# Handle a client that can now start a game
-	def client_start(self, client_soc):
-		print("[debug] socket added to active")
-		self.active_players.append(client_soc)
-		self.soc_to_game_host[client_soc] = NimGameHost(self.initial_board, self.strategy) 
-		self.soc_to_msg_send[client_soc] += encode_response(OP_START)
+	def client_start(self, player):
+		print("[debug] player added to active")
+		self.active_players.append(player)
+		game_host = NimGameHost(self.initial_board, self.strategy, self.rules, self.next_game_id)
+		self.next_game_id = self.next_game_id % GAME_ID_MAX + 1
+		if isinstance(player, (tuple, UdpSession)):
+			# the legacy protocol has no room for a token, its games can not be resumed
+			game_host.resume_token = self.new_resume_token()
+			self.resume_tokens[game_host.resume_token] = player
+		self.player_to_game_host[player] = game_host
+		self.send_to_player(player, game_host.send_start_response())
+		self.publish_game(game_host)
+
+	# Handle a session continuing a suspended game. it skips admission, and gets a new resume token
+	def client_resume(self, player, game_host):
+		print("[debug] player resumed a game")
+		self.active_players.append(player)
+		if isinstance(player, tuple):
+			self.soc_to_sessions[player[0]].add(player[1])
+		game_host.resume_token = self.new_resume_token()
+		game_host.last_seq = game_host.last_response = None    # udp sequence numbers restart with the client
+		self.resume_tokens[game_host.resume_token] = player
+		self.player_to_game_host[player] = game_host
+		self.stats['resumed_games'] += 1
+		self.send_to_player(player, game_host.send_start_response())
+		self.publish_game(game_host)
 	
 	# Handle a client we need to add to waiting queue
-	def client_wait(self, client_soc):
-		print("[debug] socket added to waiting")
-		self.waiting_queue.append(client_soc) 
-		self.soc_to_msg_send[client_soc] += encode_response(OP_WAIT)
+	def client_wait(self, player):
+		print("[debug] player added to waiting")
+		self.waiting_queue.append(player) 
+		self.send_to_player(player, encode_response(OP_WAIT))
 
-	# Handle a client we need to reject
-	def client_reject(self, client_soc):
-		print("[debug] socket added to reject")
-		self.rejected_players.append(client_soc) 
-		self.soc_to_msg_send[client_soc] += encode_response(OP_REJECT)
+	# Handle a client we need to reject. sessions are rejected without closing their connection
+	def client_reject(self, player, args=None):
+		print("[debug] player added to reject")
+		if isinstance(player, tuple):
+			self.soc_to_sessions[player[0]].discard(player[1])
+		elif isinstance(player, UdpSession):
+			self.udp_sessions.pop((player.addr, player.session_id), None)
+		else:
+			self.rejected_players.append(player) 
+		self.send_to_player(player, encode_response(OP_REJECT, args or []))
+
+	# admission of a new game, counted per game for both legacy connections and sessions
+	def handle_new_player(self, player):
+		if isinstance(player, tuple):
+			self.soc_to_sessions[player[0]].add(player[1])
+		if self.draining:
+			self.client_reject(player)
+		elif len(self.active_players) < self.num_players:
+			self.client_start(player)
+		elif len(self.waiting_queue) < self.wait_list_size:
+			self.client_wait(player)
+		else:
+			self.client_reject(player)
 
 	def handle_new_connection(self, client_soc):
 		self.soc_to_msg_recv[client_soc] = b''
 		self.soc_to_msg_send[client_soc] = b''		
-		if len(self.active_players) < self.num_players:
-			self.client_start(client_soc)
-		elif len(self.waiting_queue) < self.wait_list_size:
-			self.client_wait(client_soc)
+		self.handle_new_player(client_soc)
+
+	# a session port connection plays no game until it opens sessions
+	def handle_new_session_connection(self, client_soc):
+		self.soc_to_msg_recv[client_soc] = b''
+		self.soc_to_msg_send[client_soc] = b''
+		self.soc_to_sessions[client_soc] = set()
+
+	# a stateless port connection is served without admission, it holds no game
+	def handle_new_stateless_connection(self, client_soc):
+		self.soc_to_msg_recv[client_soc] = b''
+		self.soc_to_msg_send[client_soc] = b''
+		self.stateless_connections.add(client_soc)
+
+	# return a non-blocking unix socket on path that only the server's user can connect to
+	def listen_admin(self, path):
+		# a socket left behind by a server that did not exit cleanly
+		if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+			os.unlink(path)
+		admin_soc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		umask = os.umask(0o177)
+		try:
+			admin_soc.bind(path)
+		finally:
+			os.umask(umask)
+		admin_soc.listen()
+		admin_soc.setblocking(False)
+		return admin_soc
+
+	def handle_new_admin_connection(self, admin_soc):
+		admin_soc.setblocking(False)
+		self.admin_connections[admin_soc] = AdminConnection()
+
+	def close_admin_connection(self, admin_soc):
+		self.admin_connections.pop(admin_soc)
+		admin_soc.close()
+
+	# read admin commands and execute the complete ones
+	def handle_admin_reads(self, Readable):
+		for soc in Readable:
+			connection = self.admin_connections[soc]
+			data = recv(soc, 4096)
+			if data is None:
+				continue
+			lines = connection.feed(data) if data else None
+			if lines is None:
+				self.close_admin_connection(soc)
+				continue
+			for line in lines:
+				self.execute_admin_command(connection, line)
+
+	def handle_admin_writes(self, Writable):
+		for soc in Writable:
+			connection = self.admin_connections[soc]
+			size = send(soc, connection.send_buffer)
+			if size == -1:
+				self.close_admin_connection(soc)
+			else:
+				connection.send_buffer = connection.send_buffer[size:]
+
+	# execute a command of the admin channel and queue its answer on the connection
+	def execute_admin_command(self, connection, line):
+		command, *args = line.split()
+		if command == 'stats' and not args:
+			connection.reply([f'{name}={value}' for name, value in self.get_stats().items()])
+		elif command in ('players', 'waitlist') and len(args) == 1:
+			if not args[0].isdigit() or int(args[0]) < 1:
+				connection.reply(error=f'{command} should be a positive number')
+			elif command == 'players':
+				# running games over a lowered limit go on, no waiting player starts until under it
+				self.num_players = int(args[0])
+				self.promote_waiting_players()
+				connection.reply()
+			else:
+				# players waiting over a lowered limit keep their place
+				self.wait_list_size = int(args[0])
+				connection.reply()
+		elif command == 'strategy' and len(args) == 1:
+			if args[0] not in self.strategies:
+				connection.reply(error=f'strategy should be one of {", ".join(self.strategies)}')
+			else:
+				# running games keep the strategy they started with
+				self.set_strategy(self.strategies[args[0]])
+				connection.reply()
+		elif command == 'drain' and not args:
+			self.drain()
+			connection.reply()
 		else:
-			self.client_reject(client_soc)
+			connection.reply(error=f'unknown command {line}')
+
+	# stop admitting games: stop listening and reject the waiting players. running games go on,
+	# and session connections and udp clients opening a new game are rejected
+	def drain(self):
+		print("[debug] draining")
+		self.draining = True
+		for listen_soc in self.listeners:
+			listen_soc.close()
+		self.listeners.clear()
+		while self.waiting_queue:
+			self.client_reject(self.waiting_queue.pop(0))
+
+	# return True once the players of a draining server left and their last responses were sent.
+	# players leave after reading the winner of their game
+	def is_drained(self):
+		return self.draining and not self.active_players and not any(self.soc_to_msg_send.values())
+
+	# close every socket of the server
+	def shutdown(self):
+		self.waiting_queue.clear()
+		for soc in list(self.soc_to_msg_send):
+			self.close_connection(soc)
+		for soc in [*self.listeners, *self.admin_connections]:
+			soc.close()
+		if self.udp_soc:
+			self.udp_soc.close()
+		if self.admin_soc:
+			self.admin_soc.close()
+			os.unlink(self.admin_path)
+		if self.search_pool:
+			self.search_pool.shutdown(cancel_futures=True)
+
+	# return a non-blocking listening socket on port
+	def listen(self, port):
+		listen_soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listen_soc.bind(('', port))
+		listen_soc.listen(self.backlog)
+		listen_soc.setblocking(False)
+		return listen_soc
+
+	# accept pending connections until the accept queue is empty or ACCEPT_BATCH_MAX were accepted,
+	# so a connection storm is drained in a few iterations instead of one connection per iteration
+	def accept_connections(self, listen_soc, handle_connection):
+		for _ in range(ACCEPT_BATCH_MAX):
+			try:
+				(client_soc, address) = listen_soc.accept()
+			except BlockingIOError:
+				return
+			except OSError as error:
+				# out of file descriptors or the client gave up, retry on the next iteration
+				print(f"[debug] accept failed: {error}")
+				return
+			# python's accept uses accept4 with SOCK_CLOEXEC only, so O_NONBLOCK is set right after it
+			if self.nonblocking_accept:
+				client_soc.setblocking(False)
+			handle_connection(client_soc)
 
 	def start(self):
 		print("[debug] Server started!")
-		with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listen_soc:
-			listen_soc.bind(('', self.port))
-			listen_soc.listen()
-			while True:
-				Readable, Writable, _ = select([*self.active_players, *self.waiting_queue, *self.rejected_players, listen_soc], 
-											[*self.active_players, *self.waiting_queue, *self.rejected_players], [])
-				
-				if listen_soc in Readable:
-					(client_soc, address) = listen_soc.accept()
-					self.handle_new_connection(client_soc)
+		self.listeners[self.listen(self.port)] = self.handle_new_connection
+		if self.session_port:
+			self.listeners[self.listen(self.session_port)] = self.handle_new_session_connection
+		if self.stateless_port:
+			self.listeners[self.listen(self.stateless_port)] = self.handle_new_stateless_connection
+		if self.udp_port:
+			self.udp_soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			self.udp_soc.bind(('', self.udp_port))
+			self.udp_soc.setblocking(False)
+		if self.admin_path:
+			self.admin_soc = self.listen_admin(self.admin_path)
+		try:
+			while not self.is_drained():
+				# sockets waiting for a searched server move are not read until it is played,
+				# sockets that do not read their responses are not read until they catch up
+				readers = [soc for soc in self.soc_to_msg_send if soc not in self.pending_moves and soc not in self.paused_sockets]
+				readers += [soc for soc in (self.udp_soc, self.admin_soc) if soc]
+				writers = [soc for soc in self.soc_to_msg_send if self.soc_to_msg_send[soc]]
+				spectator_writers = [soc for soc, queue in self.spectators.items() if queue.has_data()]
+				Readable, Writable, _ = select([*readers, *self.listeners, *self.admin_connections, self.wakeup_recv_soc],
+											   [*writers, *spectator_writers], [], self.get_select_timeout())
+
+				if self.wakeup_recv_soc in Readable:
+					self.wakeup_recv_soc.recv(4096)
+					Readable.remove(self.wakeup_recv_soc)
+				self.complete_search_moves()
+				self.close_stalled_connections()
+				self.expire_udp_sessions()
+
+				if self.udp_soc in Readable:
+					self.handle_udp_reads()
+					Readable.remove(self.udp_soc)
+
+				for listen_soc in [soc for soc in Readable if soc in self.listeners]:
+					self.accept_connections(listen_soc, self.listeners[listen_soc])
 					Readable.remove(listen_soc)
 
+				# admin commands run between two rounds of player traffic, they never block on a socket
+				if self.admin_soc in Readable:
+					self.accept_connections(self.admin_soc, self.handle_new_admin_connection)
+					Readable.remove(self.admin_soc)
+				admin_readable = [soc for soc in Readable if soc in self.admin_connections]
+				Readable = [soc for soc in Readable if soc not in self.admin_connections]
+				self.handle_admin_reads(admin_readable)
+
 				self.handle_reads(Readable)
 
-				_, Writable, _ = select([], [*self.active_players, *self.waiting_queue, *self.rejected_players], [], 0)				
+				writers = [soc for soc in self.soc_to_msg_send if self.soc_to_msg_send[soc]]
+				_, Writable, _ = select([], writers, [], 0)				
 				
 				self.handle_writes(Writable)	
 
+				spectator_writers = [soc for soc, queue in self.spectators.items() if queue.has_data()]
+				if spectator_writers:
+					_, Writable, _ = select([], spectator_writers, [], 0)
+					self.handle_spectator_writes(Writable)
+
+				admin_writers = [soc for soc, connection in self.admin_connections.items() if connection.send_buffer]
+				if admin_writers:
+					_, Writable, _ = select([], admin_writers, [], 0)
+					self.handle_admin_writes(Writable)
+		finally:
+			self.shutdown()
+		print("[debug] Server drained")
+
 # ------------------------------------------------------------------------------------------------------
 
 
@@ -266,14 +979,28 @@ def validate_input(args):
 	if len(args) == 6 and not args[5].isdigit():
 		exit('Port should be a positive number')
 	
-	flag_list = ['--optimal-strategy', '--multithreading']
+	flag_list = ['--optimal-strategy', '--multithreading', '--nonblocking-accept']
+	value_flag_list = ['--solver-table', '--difficulty', '--move-budget', '--search-workers', '--session-port',
+					   '--output-watermarks', '--backlog', '--stateless-port', '--stateless-key-file', '--udp-port',
+					   '--admin-socket']
 	for i in range(6, len(args)):
+		name = args[i].split('=')[0]
+		if '=' in args[i] and name in value_flag_list:
+			value_flag_list.remove(name)
+			continue
 		if args[i] not in flag_list:
 			exit('Invalid flags')
 		flag_list.remove(args[i])
 
 	return True
 
+# return the value of a --name=value flag, or <default> if it was not given
+def get_flag_value(args, name, default=None):
+	for arg in args:
+		if arg.startswith(name + '='):
+			return arg.split('=', 1)[1]
+	return default
+
 def naive_strategy(board):
 	max_heap_index = board.index(max(board))
 	return max_heap_index, 1
@@ -285,6 +1012,8 @@ def optimal_strategy(board):
 		if target_size < heap:
 			amount_to_remove = heap - target_size
 			return index, amount_to_remove	
+	# losing position, any move will do
+	return naive_strategy(board)
 
 def main():
 	args = sys.argv[1:]
@@ -296,13 +1025,89 @@ def main():
 	wait_list_size = int(args[BOARD_SIZE+1])
 	multithreading = True if ('--multithreading' in args) else False
 	strategy = optimal_strategy if ('--optimal-strategy' in args) else naive_strategy
-	
+	rules = None
+	# strategies the admin channel can switch to
+	strategies = {'naive': naive_strategy, 'optimal': optimal_strategy}
+
+	solver_table = get_flag_value(args, '--solver-table')
+	if solver_table is not None:
+		try:
+			solver = NimSolver.load(solver_table)
+		except (OSError, ValueError) as error:
+			exit(f'Could not load solver table: {error}')
+		if max(board) > solver.max_heap:
+			exit(f'Solver table only covers heaps up to {solver.max_heap}')
+		strategy = solver.best_move
+		rules = solver.rules
+		if rules != NimRules():
+			# naive and optimal play normal nim, their moves may break the variant's rules
+			strategies = {}
+		strategies['table'] = solver.best_move
+
+	# search strategies fall back to the table / naive strategy when they miss the per move budget
+	difficulty = get_flag_value(args, '--difficulty')
+	move_budget = get_flag_value(args, '--move-budget', str(int(SEARCH_DEFAULT_BUDGET * 1000)))
+	search_workers = get_flag_value(args, '--search-workers')
+	if not move_budget.isdigit() or int(move_budget) < 1:
+		exit('Move budget should be a positive number of milliseconds')
+	if search_workers is not None and (not search_workers.isdigit() or int(search_workers) < 1):
+		exit('Number of search workers should be positive')
+	search_workers = int(search_workers) if search_workers else None
+	for name in SEARCH_DIFFICULTIES:
+		strategies[name] = SearchStrategy(name, strategy, rules, int(move_budget) / 1000)
+	if difficulty is not None:
+		if difficulty not in SEARCH_DIFFICULTIES:
+			exit(f'unknown difficulty {difficulty}')
+		strategy = strategies[difficulty]
+
+	session_port = get_flag_value(args, '--session-port')
+	if session_port is not None and not session_port.isdigit():
+		exit('Session port should be a positive number')
+	session_port = int(session_port) if session_port else None
+
+	output_watermarks = get_flag_value(args, '--output-watermarks', f'{OUTPUT_LOW_WATERMARK},{OUTPUT_HIGH_WATERMARK}')
+	output_watermarks = output_watermarks.split(',')
+	if len(output_watermarks) != 2 or not all(mark.isdigit() for mark in output_watermarks):
+		exit('Output watermarks should be LOW,HIGH byte counts')
+	output_watermarks = tuple(map(int, output_watermarks))
+	if not output_watermarks[0] < output_watermarks[1]:
+		exit('Output watermarks should satisfy LOW < HIGH')
+
+	backlog = get_flag_value(args, '--backlog', str(SERVER_DEFAULT_BACKLOG))
+	if not backlog.isdigit() or int(backlog) < 1:
+		exit('Backlog should be a positive number')
+	nonblocking_accept = '--nonblocking-accept' in args
+
+	# every server instance of a stateless deployment is given the same key
+	stateless_port = get_flag_value(args, '--stateless-port')
+	state_codec = None
+	if stateless_port is not None:
+		key_file = get_flag_value(args, '--stateless-key-file')
+		if not stateless_port.isdigit() or key_file is None:
+			exit('Stateless mode needs a port and --stateless-key-file')
+		try:
+			state_codec = StateTokenCodec(load_state_key(key_file))
+		except (OSError, ValueError) as error:
+			exit(f'Could not load the state key: {error}')
+		stateless_port = int(stateless_port)
+
+	udp_port = get_flag_value(args, '--udp-port')
+	if udp_port is not None and not udp_port.isdigit():
+		exit('UDP port should be a positive number')
+	udp_port = int(udp_port) if udp_port else None
+
+	admin_path = get_flag_value(args, '--admin-socket')
+	if admin_path is not None and not hasattr(socket, 'AF_UNIX'):
+		exit('The admin socket needs unix domain sockets')
+
 	nim_server = None
 	if multithreading:
 		print('Multithreading is not implemented')
 		exit()
 	else:
-		nim_server = NimServerMultiplexing(board, port, num_players, wait_list_size, strategy)
+		nim_server = NimServerMultiplexing(board, port, num_players, wait_list_size, strategy, rules, search_workers, session_port,
+											   output_watermarks, int(backlog), nonblocking_accept, stateless_port, state_codec,
+											   udp_port, admin_path, strategies)
 	
 	nim_server.start()
 	
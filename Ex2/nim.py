@@ -1,6 +1,7 @@
 import socket
 import struct
 import sys
+import time
 from select import select
 
 from nim_constants import *
@@ -63,23 +64,43 @@ def handle_move_response(response):
         exit()
 
 
-def handle_pre_game_state(response):
-    op, *args = struct.unpack(PACKET_STRUCT, response)
+# on the session port OP_START is followed by the resume token of the game
+def handle_pre_game_state(response, game):
+    op, *args = struct.unpack(PACKET_STRUCT, response[:PACKET_SIZE])
     if op == OP_REJECT:
         exit("You are rejected by the server.")
     elif op == OP_WAIT:
         print("Waiting to play against the server.")
         return STATE_PRE_GAME
     elif op == OP_START:
+        game['id'] = args[0]
+        if len(response) > PACKET_SIZE:
+            game['token'] = response[PACKET_SIZE:]
         print("Now you are playing against the server!")
         return STATE_SEND_GAME_STATE_REQ
 
     exit("Unknown pre-game operation")
 
 
-def handle_read(recv_buffer, state):
+# the server refuses to resume a game it no longer keeps, or that is not running yet after a restart
+def handle_resume_state(response, game):
+    op, *args = struct.unpack(PACKET_STRUCT, response[:PACKET_SIZE])
+    if op == OP_REJECT:
+        return STATE_PRE_GAME
+    elif op == OP_START:
+        game['token'] = response[PACKET_SIZE:]
+        print("Your game was resumed!")
+        return STATE_SEND_GAME_STATE_REQ
+
+    exit("Unknown resume operation")
+
+
+def handle_read(recv_buffer, state, game):
     if state == STATE_PRE_GAME:
-        return handle_pre_game_state(recv_buffer)
+        return handle_pre_game_state(recv_buffer, game)
+
+    elif state == STATE_RESUME:
+        return handle_resume_state(recv_buffer, game)
 
     elif state == STATE_RECV_GAME_STATE_REQ:
         print_game_state_response(recv_buffer)
@@ -93,33 +114,47 @@ def handle_read(recv_buffer, state):
     return state
 
 
-def start_client(hostname, port):
+# play on one connection until it is lost. on the session port every packet is prefixed with
+# the id of the session the game is played in, and a game can be resumed
+def run_connection(hostname, port, state, game, session=False):
+    resuming = state == STATE_RESUME
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as soc:
         try:
             #print("Connecting to port", port, "...")
             soc.connect((hostname, port))
         except ConnectionRefusedError:
+            if state == STATE_RESUME:
+                return
             print('Connection Refused')
             exit()
 
+        if resuming:
+            resume = encode_response(OP_RESUME, [game['id']]) + game['token']
+            soc.sendall(encode_session_packet(CLIENT_SESSION_ID, resume))
+        elif session:
+            soc.sendall(encode_session_packet(CLIENT_SESSION_ID, encode_response(OP_SESSION_OPEN)))
+
         move = None
-        state = STATE_PRE_GAME
         recv_buffer = b''
         total_sent = 0
         while True:
             readables, writeables, _ = select([soc, sys.stdin], [soc], [])
 
             if soc in readables:
-                response = recv(soc, PACKET_SIZE - len(recv_buffer))
+                packet_size = get_session_packet_size(recv_buffer) if session else PACKET_SIZE
+                response = recv(soc, packet_size - len(recv_buffer))
                 if not response:
-                    exit()
+                    return
 
                 recv_buffer += response
-                if len(recv_buffer) < PACKET_SIZE:
+                packet_size = get_session_packet_size(recv_buffer) if session else PACKET_SIZE
+                if len(recv_buffer) < packet_size:
                     continue
 
-                state = handle_read(recv_buffer, state)
+                state = handle_read(recv_buffer[SESSION_PACKET_SIZE - PACKET_SIZE:] if session else recv_buffer, state, game)
                 recv_buffer = b''
+                if resuming and state == STATE_PRE_GAME:
+                    return
 
             if sys.stdin in readables:
                 message = sys.stdin.readline().strip()
@@ -136,13 +171,15 @@ def start_client(hostname, port):
                     to_send = encode_response(OP_GAME_STATE)
                 else:
                     continue
+                if session:
+                    to_send = encode_session_packet(CLIENT_SESSION_ID, to_send)
 
                 sent = send(soc, to_send[total_sent:])
                 if not sent:
-                    exit()
+                    return
 
                 total_sent += sent
-                if total_sent < PACKET_SIZE:
+                if total_sent < len(to_send):
                     continue
 
                 if state == STATE_SEND_MOVE:
@@ -155,16 +192,34 @@ def start_client(hostname, port):
                 total_sent = 0
 
 
+# play a game. if the server's session port is given, the game is played on it and resumed
+# when the connection is lost after the game started
+def start_client(hostname, port, session_port=None):
+    game = {}  # id and resume token of the game being played
+    if session_port is None:
+        run_connection(hostname, port, STATE_PRE_GAME, game)
+        exit()
+    run_connection(hostname, session_port, STATE_PRE_GAME, game, session=True)
+    if 'token' not in game:
+        exit()
+    for _ in range(RESUME_RETRY_ATTEMPTS):
+        print("Connection lost, resuming the game...")
+        time.sleep(RESUME_RETRY_INTERVAL)
+        run_connection(hostname, session_port, STATE_RESUME, game, session=True)
+    exit("Your game could not be resumed.")
+
+
 def main():
     args = sys.argv[1:]
 
-    if len(args) >= 2 and not args[1].isdigit():
+    if len(args) >= 2 and not all(arg.isdigit() for arg in args[1:3]):
         print('Port must be a positive integer!')
         exit()
 
     hostname = args[0] if len(args) >= 1 else SERVER_DEFAULT_HOSTNAME
     port = int(args[1]) if len(args) >= 2 else SERVER_DEFAULT_PORT
-    start_client(hostname, port)
+    session_port = int(args[2]) if len(args) >= 3 else None
+    start_client(hostname, port, session_port)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import socket
+import sys
+
+# > Admin channel
+#
+# A unix socket, readable by the server's user only, accepting one text command per line:
+#
+#   stats                print the server's counters
+#   players N            play at most N games at once, waiting players are promoted right away
+#   waitlist N           keep at most N players waiting
+#   strategy NAME        play new games with another strategy
+#   drain                stop admitting games and exit once the running games are over
+#
+# Every command is answered with zero or more "key=value" lines followed by a line that is
+# either "ok" or "error: <reason>". Lowering a limit never ends a running game, the server
+# only admits fewer games until it is under the new limit.
+
+ADMIN_MAX_LINE = 256                # longest command accepted, longer lines close the connection
+ADMIN_TIMEOUT = 5                   # seconds the admin client waits for an answer
+
+
+# buffers of an admin connection, handled by the server's event loop
+class AdminConnection:
+	def __init__(self):
+		self.recv_buffer = b''
+		self.send_buffer = b''
+
+	# add received bytes and return the complete command lines, or None if a line is too long
+	def feed(self, data):
+		self.recv_buffer += data
+		*lines, self.recv_buffer = self.recv_buffer.split(b'\n')
+		if len(self.recv_buffer) > ADMIN_MAX_LINE or any(len(line) > ADMIN_MAX_LINE for line in lines):
+			return None
+		return [line.decode('ascii', 'replace').strip() for line in lines if line.strip()]
+
+	def reply(self, lines=(), error=None):
+		for line in lines:
+			self.send_buffer += f'{line}\n'.encode('ascii')
+		self.send_buffer += (f'error: {error}\n' if error else 'ok\n').encode('ascii')
+
+
+# ------- Client ---------------------------------------
+
+# send a command to the server listening on <path>. return its answer lines and its final
+# "ok" or "error: <reason>" line
+def admin_request(path, command):
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as soc:
+		soc.settimeout(ADMIN_TIMEOUT)
+		soc.connect(path)
+		soc.sendall(command.encode('ascii') + b'\n')
+		lines = []
+		data = b''
+		while not lines or not (lines[-1] == 'ok' or lines[-1].startswith('error: ')):
+			chunk = soc.recv(4096)
+			if not chunk:
+				raise ConnectionError('server closed the admin connection')
+			*complete, data = (data + chunk).split(b'\n')
+			lines += [line.decode('ascii') for line in complete]
+	return lines[:-1], lines[-1]
+
+
+def main():
+	args = sys.argv[1:]
+	if len(args) < 2:
+		exit('Usage: nim_admin.py <admin-socket> stats | players N | waitlist N | strategy NAME | drain')
+	try:
+		lines, status = admin_request(args[0], ' '.join(args[1:]))
+	except OSError as error:
+		exit(f'Could not reach the server: {error}')
+	for line in lines:
+		print(line)
+	if status != 'ok':
+		exit(status)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import itertools
+import json
+import os
+import random
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import time
+import timeit
+
+from nim_helper import *
+from nim_constants import *
+from nim_stateless import StateTokenCodec, ReplayCache
+from nim_solver import NimRules, NimSolver, build_table
+
+# > Benchmarks
+#
+# usage: nim_bench.py [--save] [--check] [--threshold=0.25] [--baseline=PATH]
+#        nim_bench.py --storm[=CONNECTIONS] [--backlog=N] [--nonblocking-accept]
+#
+# The correctness properties always run first and a failing property aborts the run,
+# so a performance change is only measured once it is known to play by the rules.
+# --save stores the timings as the baseline, --check fails if any benchmark got slower
+# than the baseline by more than the threshold. Timings only compare on the machine that
+# measured them, so the baseline is local-only: it is not committed, run --save once on a
+# machine before using --check there.
+# --storm starts a server and measures how long a burst of simultaneous connections waits
+# for its first packet, the server flags given after it are passed to the server.
+
+BENCH_DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nim_bench_baseline.json')
+BENCH_DEFAULT_THRESHOLD = 0.25      # allowed slowdown relative to the baseline
+BENCH_REPEAT = 7
+PROPERTY_ROUNDS = 2000
+SOLVER_PROPERTY_MAX_HEAP = 8         # the solver is checked on every board with heaps up to this size
+SOLVER_PROPERTY_RULES = [NimRules(), NimRules(misere=True), NimRules(subtraction_set=[1, 2, 3]),
+						 NimRules(subtraction_set=[1, 3, 4])]
+STORM_DEFAULT_CONNECTIONS = 500
+STORM_TIMEOUT = 30                  # seconds a storm connection may wait for its first packet
+
+
+# the server module has a dash in its file name, load it by path
+def load_server_module():
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nim-server.py')
+	spec = importlib.util.spec_from_file_location('nim_server', path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+
+def random_board(rng):
+	return [rng.randint(0, 1000) for _ in range(BOARD_SIZE)]
+
+
+# ------- Correctness properties -----------------------
+
+def check_game_move(server, rng):
+	for _ in range(PROPERTY_ROUNDS):
+		board = random_board(rng)
+		game = server.Game(board)
+		heap, num = rng.randint(-1, BOARD_SIZE), rng.randint(-1, 1001)
+		legal = 0 <= heap < BOARD_SIZE and 0 <= num <= board[heap]
+		assert game.validate_move(heap, num) == legal, (board, heap, num)
+		assert game.move(heap, num) == legal, (board, heap, num)
+
+		expected = board.copy()
+		if legal:
+			expected[heap] -= num
+		assert game.get_board_status() == expected, (board, heap, num)
+		assert game.is_done() == (sum(expected) == 0)
+
+
+def check_game_winner(server, rng):
+	for _ in range(PROPERTY_ROUNDS // 10):
+		game = server.Game([rng.randint(1, 20) for _ in range(BOARD_SIZE)])
+		last_mover = None
+		while not game.done:
+			assert game.get_winner() == -1
+			board = game.get_board_status()
+			heap = rng.choice([index for index in range(BOARD_SIZE) if board[index] > 0])
+			last_mover = game.turn
+			game.move(heap, rng.randint(1, board[heap]))
+		assert game.get_winner() == last_mover
+
+
+def check_codec(server, rng):
+	for _ in range(PROPERTY_ROUNDS):
+		op = rng.randint(OP_MOVE, OP_REJECT)
+		args = [rng.randint(-1, 1000) for _ in range(rng.randint(0, 3))]
+		packet = encode_response(op, args.copy())
+		assert len(packet) == PACKET_SIZE
+		assert struct.unpack(PACKET_STRUCT, packet) == (op, *args, *[NONE] * (3 - len(args)))
+
+
+# OP_START and OP_RESUME session packets are followed by a resume token. a stream of session
+# packets is split back into the packets it was built from
+def check_resume_token(server, rng):
+	for _ in range(PROPERTY_ROUNDS // 10):
+		packets = []
+		for _ in range(rng.randint(1, 10)):
+			op = rng.choice([OP_START, OP_RESUME, OP_GAME_ACTIVE, OP_MOVE])
+			packet = encode_session_packet(rng.randint(1, SESSION_ID_MAX), encode_response(op, [rng.randint(1, GAME_ID_MAX)]))
+			if op in (OP_START, OP_RESUME):
+				packet += rng.randbytes(RESUME_TOKEN_SIZE)
+			assert get_session_packet_size(packet[:rng.randrange(SESSION_PACKET_SIZE)]) == SESSION_PACKET_SIZE
+			packets.append(packet)
+
+		stream = b''.join(packets)
+		for packet in packets:
+			size = get_session_packet_size(stream)
+			assert stream[:size] == packet, (packet, stream[:size])
+			stream = stream[size:]
+
+
+def check_strategies(server, rng):
+	for _ in range(PROPERTY_ROUNDS):
+		board = random_board(rng)
+		if sum(board) == 0:
+			continue
+		for strategy in (server.naive_strategy, server.optimal_strategy):
+			heap, num = strategy(board)
+			assert 0 <= heap < BOARD_SIZE and 1 <= num <= board[heap], (strategy.__name__, board, heap, num)
+
+		nim_sum = board[0] ^ board[1] ^ board[2]
+		heap, num = server.optimal_strategy(board)
+		after = board.copy()
+		after[heap] -= num
+		if nim_sum != 0:
+			assert after[0] ^ after[1] ^ after[2] == 0, (board, heap, num)
+
+
+# return True iff the player to move wins <board> under <rules>, by trying every move
+def brute_force_wins(board, rules, memo):
+	if sum(board) == 0:
+		return rules.misere         # the previous player took the last item
+	key = tuple(sorted(board))
+	if key not in memo:
+		memo[key] = False
+		for index, heap in enumerate(board):
+			for take in rules.legal_takes(heap):
+				after = board.copy()
+				after[index] -= take
+				if not brute_force_wins(after, rules, memo):
+					memo[key] = True
+					break
+			if memo[key]:
+				break
+	return memo[key]
+
+
+# the solver's move is legal, and leaves a lost position whenever the board is won
+def check_solver(server, rng):
+	for rules in SOLVER_PROPERTY_RULES:
+		solver = NimSolver(build_table(rules, SOLVER_PROPERTY_MAX_HEAP))
+		memo = {}
+		for board in itertools.product(range(SOLVER_PROPERTY_MAX_HEAP + 1), repeat=BOARD_SIZE):
+			board = list(board)
+			if sum(board) == 0:
+				continue
+			heap, num = solver.best_move(board)
+			assert 0 <= heap < BOARD_SIZE and num in rules.legal_takes(board[heap]), (vars(rules), board, heap, num)
+			after = board.copy()
+			after[heap] -= num
+			if brute_force_wins(board, rules, memo):
+				assert not brute_force_wins(after, rules, memo), (vars(rules), board, heap, num)
+
+
+def check_game_host(server, rng):
+	for _ in range(PROPERTY_ROUNDS // 10):
+		board = [rng.randint(1, 30) for _ in range(BOARD_SIZE)]
+		host = server.NimGameHost(board, server.optimal_strategy)
+		while True:
+			state = struct.unpack(PACKET_STRUCT, host.execute_command(OP_GAME_STATE, [NONE] * 3))
+			if state[0] == OP_GAME_DONE:
+				assert state[1] in (ARG_CLIENT, ARG_SERVER) and sum(host.game.get_board_status()) == 0
+				break
+			assert state[0] == OP_GAME_ACTIVE and list(state[1:]) == host.game.get_board_status()
+
+			heap = rng.choice([index for index in range(BOARD_SIZE) if state[1 + index] > 0])
+			num = rng.randint(1, state[1 + heap])
+			op, validity, *_ = struct.unpack(PACKET_STRUCT, host.execute_command(OP_MOVE, [heap, num, NONE]))
+			assert op == OP_MOVE_RESPONSE and validity == ARG_MOVE_ACCEPTED
+			assert sum(host.game.get_board_status()) < sum(state[1:]) - num or host.game.done
+
+
+PROPERTIES = [check_game_move, check_game_winner, check_codec, check_resume_token, check_strategies, check_solver,
+			  check_game_host]
+
+
+def run_properties(server):
+	rng = random.Random(0)
+	for prop in PROPERTIES:
+		prop(server, rng)
+		print(f'[ok] {prop.__name__}')
+
+
+# ------- Benchmarks -----------------------------------
+
+# return {benchmark name: (setup callable, statement callable)}. setup builds fresh state
+# for every repetition so stateful statements are measured on the same inputs
+def get_benchmarks(server):
+	board = [731, 402, 919]
+	packet = encode_response(OP_MOVE, [1, 3])
+
+	codec = StateTokenCodec(bytes(32))
+	token = codec.sign(1, 1, board, ARG_CLIENT)
+
+	def game_host():
+		return server.NimGameHost([30000] * BOARD_SIZE, server.naive_strategy)
+
+	return {
+		'game.validate_move': (lambda: server.Game(board), lambda game: game.validate_move(1, 3)),
+		'game.is_done': (lambda: server.Game(board), lambda game: game.is_done()),
+		'game.move': (lambda: server.Game([30000] * BOARD_SIZE), lambda game: game.move(1, 1)),
+		'host.execute_command.move': (game_host, lambda host: host.execute_command(OP_MOVE, [0, 1, NONE])),
+		'host.execute_command.game_state': (game_host, lambda host: host.execute_command(OP_GAME_STATE, [NONE] * 3)),
+		'encode_response': (lambda: None, lambda _: encode_response(OP_GAME_ACTIVE, board.copy())),
+		'decode_packet': (lambda: None, lambda _: struct.unpack(PACKET_STRUCT, packet)),
+		'naive_strategy': (lambda: None, lambda _: server.naive_strategy(board)),
+		'optimal_strategy': (lambda: None, lambda _: server.optimal_strategy(board)),
+		'state_token.sign': (lambda: None, lambda _: codec.sign(1, 1, board, ARG_CLIENT)),
+		'state_token.verify': (lambda: None, lambda _: codec.verify(token)),
+		'replay_cache.consume': (lambda: ReplayCache(), lambda cache: cache.consume(1, random.getrandbits(32), 2 ** 32 - 1)),
+	}
+
+
+# return the best time per call, in nanoseconds, of every benchmark
+def run_benchmarks(server, number=10000):
+	results = {}
+	for name, (setup, statement) in get_benchmarks(server).items():
+		timings = []
+		for _ in range(BENCH_REPEAT):
+			state = setup()
+			timings.append(timeit.timeit(lambda: statement(state), number=number))
+		results[name] = min(timings) / number * 1e9
+		print(f'{name:35} {results[name]:10.1f} ns/op')
+	return results
+
+
+# return the names of the benchmarks that are slower than the baseline by more than <threshold>
+def find_regressions(results, baseline, threshold):
+	regressions = []
+	for name, elapsed in results.items():
+		if name in baseline and elapsed > baseline[name] * (1 + threshold):
+			regressions.append(name)
+			print(f'[regression] {name}: {elapsed:.1f} ns/op, baseline {baseline[name]:.1f} ns/op')
+	return regressions
+
+
+# ------- Connection storm -----------------------------
+
+# start a server on a free port admitting <players> games. return the process and the port
+def start_server(players, server_args):
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+		probe.bind(('', 0))
+		port = probe.getsockname()[1]
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nim-server.py')
+	process = subprocess.Popen([sys.executable, path, '5', '6', '7', str(players), str(players), str(port), *server_args],
+							   stdout=subprocess.DEVNULL)
+	for _ in range(100):
+		try:
+			socket.create_connection(('localhost', port)).close()
+			return process, port
+		except ConnectionRefusedError:
+			time.sleep(0.05)
+	process.kill()
+	exit('Server did not start')
+
+
+# open <connections> connections at once and return the seconds each one waited for its
+# first packet (START / WAIT / REJECT), and the number of connections that failed
+def run_connect_storm(port, connections):
+	selector = selectors.DefaultSelector()
+	started = {}
+	for _ in range(connections):
+		soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		soc.setblocking(False)
+		soc.connect_ex(('localhost', port))
+		started[soc] = time.time()
+		selector.register(soc, selectors.EVENT_READ)
+
+	latencies = []
+	failures = 0
+	deadline = time.time() + STORM_TIMEOUT
+	while started and time.time() < deadline:
+		for key, _ in selector.select(timeout=deadline - time.time()):
+			soc = key.fileobj
+			try:
+				ok = len(soc.recv(PACKET_SIZE)) > 0
+			except OSError:
+				ok = False
+			if ok:
+				latencies.append(time.time() - started[soc])
+			else:
+				failures += 1
+			selector.unregister(soc)
+			soc.close()
+			started.pop(soc)
+
+	failures += len(started)
+	for soc in started:
+		soc.close()
+	return latencies, failures
+
+
+def report_connect_storm(connections, server_args):
+	process, port = start_server(connections, server_args)
+	try:
+		latencies, failures = run_connect_storm(port, connections)
+	finally:
+		process.kill()
+
+	latencies.sort()
+	print(f'connect storm: {connections} connections, {failures} failed')
+	if latencies:
+		for name, quantile in (('p50', 0.5), ('p99', 0.99), ('max', 1)):
+			print(f'{name:5} {latencies[min(int(len(latencies) * quantile), len(latencies) - 1)] * 1000:10.2f} ms')
+
+
+def main():
+	args = sys.argv[1:]
+	storm_args = [arg for arg in args if arg == '--storm' or arg.startswith('--storm=')]
+	if storm_args:
+		connections = storm_args[0].split('=', 1)[1] if '=' in storm_args[0] else STORM_DEFAULT_CONNECTIONS
+		report_connect_storm(int(connections), [arg for arg in args if arg not in storm_args])
+		return
+
+	server = load_server_module()
+	baseline_path = server.get_flag_value(args, '--baseline', BENCH_DEFAULT_BASELINE)
+	threshold = float(server.get_flag_value(args, '--threshold', BENCH_DEFAULT_THRESHOLD))
+
+	run_properties(server)
+	results = run_benchmarks(server)
+
+	if '--save' in args:
+		with open(baseline_path, 'w') as baseline_file:
+			json.dump(results, baseline_file, indent=2, sort_keys=True)
+		print(f'Baseline saved to {baseline_path}')
+
+	if '--check' in args:
+		if not os.path.exists(baseline_path):
+			exit(f'No baseline at {baseline_path}, run with --save first')
+		with open(baseline_path) as baseline_file:
+			baseline = json.load(baseline_file)
+		if find_regressions(results, baseline, threshold):
+			exit('Performance regression detected')
+		print('No regressions')
+
+
+if __name__ == "__main__":
+	main()
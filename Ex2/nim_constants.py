@@ -6,21 +6,48 @@ NONE = -1  # used as null argument
 
 SERVER_DEFAULT_HOSTNAME = 'localhost'
 SERVER_DEFAULT_PORT = 6444
+SERVER_DEFAULT_BACKLOG = 1024   # pending connections the kernel queues for accept, capped by somaxconn
+ACCEPT_BATCH_MAX = 256          # connections accepted per event loop iteration
 
 BOARD_SIZE = 3
 
 PACKET_SIZE = 8         # size of packet structure
 PACKET_STRUCT = ">4h"   # packet structure, 4 shorts : 1 for op code, 3 for arguments
 
+SESSION_HEADER_STRUCT = ">H"                # session id prepended to packets on the session port
+SESSION_PACKET_SIZE = 10                    # size of a session packet: session id + packet
+SESSION_PACKET_STRUCT = ">H4h"              # session id followed by the packet structure
+SESSION_ID_MAX = 65535                      # session ids are 1..SESSION_ID_MAX, 0 is reserved for the connection
+GAME_ID_MAX = 32767                         # game ids are 1..GAME_ID_MAX so they fit in a packet argument
+
+OUTPUT_LOW_WATERMARK = 1024       # resume reading from a paused socket once its output buffer drains below this
+OUTPUT_HIGH_WATERMARK = 4096      # stop reading from a socket whose output buffer reaches this
+OUTPUT_STALL_TIMEOUT = 10         # seconds a socket may stay paused before its connection is closed
+
+RESUME_TOKEN_SIZE = 8             # random bytes of a resume token, sent after OP_START and OP_RESUME packets
+RESUME_TTL = 60                   # seconds the game of a disconnected player is kept for it to resume
+RESUME_CACHE_SIZE = 1024          # suspended games kept, the oldest one is dropped beyond this
+RESUME_RETRY_ATTEMPTS = 5         # reconnections a client attempts to resume its game
+RESUME_RETRY_INTERVAL = 1         # seconds between these attempts
+CLIENT_SESSION_ID = 1             # session the client plays its game in, on the session port
+
 ARG_MOVE_ACCEPTED = 1  # move provided by user was accepted
 ARG_MOVE_ILLEGAL = 2  # move provided by user is illegal
 ARG_SERVER = 1  # used to indicate that the winner was the server
 ARG_CLIENT = 2  # used to indicate that the winner was the client
+ARG_TOKEN_INVALID = 3  # state token signature did not verify (stateless port), or unknown resume token
+ARG_TOKEN_EXPIRED = 4  # state token expired (stateless port)
+ARG_TOKEN_REPLAYED = 5  # state token was already used for a move (stateless port)
 
 # ------- Operations received from client  -------------
 
 OP_MOVE = 1  # Client requested to make a move
 OP_GAME_STATE = 2  # Client requested to get game state
+OP_SESSION_OPEN = 9  # Client requested to open a new game session (session port only)
+OP_SESSION_CLOSE = 10  # Client closed a game session (session port only)
+OP_SPECTATE = 11  # Client subscribed to updates of a game id, or of every game with NONE (session port only)
+OP_STATELESS_NEW = 12  # Client requested a new game (stateless port only)
+OP_RESUME = 13  # Client continues its game in a new session. additional packet info includes the game id, the packet is followed by the resume token (session port and udp only)
 
 # ------- Operations sent to client  -------------------
 
@@ -28,7 +55,7 @@ OP_GAME_DONE     = 3  # Indicating that a game is finished. additional packet in
 OP_GAME_ACTIVE   = 4  # Indication that a game is active and waiting for a move. provides boards status info.
 OP_MOVE_RESPONSE = 5  # Response for a client move. additional packet info includes if move was accepted or illegal
 
-OP_START      = 6  # Sent to client if the server is available
+OP_START      = 6  # Sent to client if the server is available. additional packet info includes the game id, on the session port and udp the packet is followed by the resume token
 OP_WAIT       = 7  # Sent to client if it was added to waiting list
 OP_REJECT        = 8  # Sent to client if server is busy
 
@@ -37,6 +64,7 @@ STATE_SEND_MOVE = 1
 STATE_RECV_MOVE = 2
 STATE_SEND_GAME_STATE_REQ = 3
 STATE_RECV_GAME_STATE_REQ = 4
+STATE_RESUME = 5
 
 
 LEGAL_MOVES = ['A', 'B', 'C']
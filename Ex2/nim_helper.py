@@ -12,6 +12,8 @@ def send(soc, packet):
 	try:
 		len = soc.send(packet)
 		return len
+	except BlockingIOError:
+		return 0
 	except OSError as error:
 		if error.errno == errno.EPIPE or error.errno == errno.ECONNRESET:
 			print("socket connection broken")
@@ -20,11 +22,14 @@ def send(soc, packet):
 		return -1
 
 
-# receive size bytes, return msg received or empty message upon failure
+# receive size bytes, return msg received or empty message upon failure.
+# return None if a non-blocking socket has nothing to read
 def recv(soc, size):
 	try:
 		msg = soc.recv(size)
 		return msg
+	except BlockingIOError:
+		return None
 	except OSError as error:
 		if error.errno == errno.ECONNREFUSED:
 			print("socket connection refused")
@@ -39,3 +44,17 @@ def encode_response(op, args=[]):
 	args.extend([NONE]*(3-len(args))) # pad to fit packet structure
 	packet_bytes = struct.pack(PACKET_STRUCT, op, *args)
 	return packet_bytes
+
+
+# prefix an encoded packet with its session id, for the session port
+def encode_session_packet(session_id, packet_bytes):
+	return struct.pack(SESSION_HEADER_STRUCT, session_id) + packet_bytes
+
+
+# return the size of the session packet at the start of buffer. OP_START and OP_RESUME packets
+# are followed by a resume token, so the size is only known once the packet itself arrived
+def get_session_packet_size(buffer):
+	if len(buffer) < SESSION_PACKET_SIZE:
+		return SESSION_PACKET_SIZE
+	op = struct.unpack(SESSION_PACKET_STRUCT, buffer[:SESSION_PACKET_SIZE])[1]
+	return SESSION_PACKET_SIZE + RESUME_TOKEN_SIZE if op in (OP_START, OP_RESUME) else SESSION_PACKET_SIZE
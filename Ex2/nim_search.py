@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import random
+import time
+
+from nim_constants import *
+from nim_solver import NimRules
+
+# > Search strategies
+#
+# Search based strategies are too slow to run on the server's event loop. The server
+# submits them to a process pool with a deadline and plays the fallback move if the
+# search did not answer in time. Everything a worker runs lives in this module so it
+# can be pickled and imported by the pool's processes.
+
+SEARCH_DEFAULT_BUDGET = 0.5         # seconds the server waits for a search move
+SEARCH_DEADLINE_MARGIN = 0.8        # share of the budget the worker may spend searching
+
+WIN = 1
+LOSS = -1
+UNKNOWN = 0
+
+
+# return every legal move on <board> as (heap index, amount)
+def legal_moves(board, rules):
+	return [(index, take) for index, heap in enumerate(board) for take in rules.legal_takes(heap)]
+
+
+def apply_move(board, move):
+	heap_index, take = move
+	board = list(board)
+	board[heap_index] -= take
+	return board
+
+
+# score of a finished game for the player to move
+def terminal_score(rules):
+	return WIN if rules.misere else LOSS
+
+
+class SearchTimeout(Exception):
+	pass
+
+
+# negamax bounded by <depth>. return WIN / LOSS for the player to move, UNKNOWN when
+# the depth runs out before the game is decided
+def negamax(board, rules, depth, deadline, memo):
+	if sum(board) == 0:
+		return terminal_score(rules)
+	if depth == 0:
+		return UNKNOWN
+
+	key = (tuple(sorted(board)), depth)
+	if key in memo:
+		return memo[key]
+	if time.time() >= deadline:
+		raise SearchTimeout()
+
+	best = LOSS
+	for move in legal_moves(board, rules):
+		score = -negamax(apply_move(board, move), rules, depth - 1, deadline, memo)
+		if score > best:
+			best = score
+			if best == WIN:
+				break
+	memo[key] = best
+	return best
+
+
+# iterative deepening up to <depth>, keeping the best move of the last completed depth
+def depth_limited_search(board, rules, depth, deadline):
+	moves = legal_moves(board, rules)
+	random.shuffle(moves)
+	best_move = moves[0]
+	memo = {}
+	for current_depth in range(1, depth + 1):
+		try:
+			scores = [(-negamax(apply_move(board, move), rules, current_depth - 1, deadline, memo), move) for move in moves]
+		except SearchTimeout:
+			break
+		best_score, best_move = max(scores, key=lambda scored: scored[0])
+		if best_score == WIN:
+			break
+	return best_move
+
+
+# play random moves to the end of the game. return True iff the player to move wins
+def random_playout(board, rules):
+	board = list(board)
+	took_last = False
+	while sum(board) > 0:
+		board = apply_move(board, random.choice(legal_moves(board, rules)))
+		took_last = not took_last
+	return not took_last if rules.misere else took_last
+
+
+# monte-carlo search: spread up to <playouts> random playouts over the candidate moves and
+# return the move with the best win rate
+def monte_carlo_search(board, rules, playouts, deadline):
+	moves = legal_moves(board, rules)
+	wins = [0] * len(moves)
+	plays = [0] * len(moves)
+	for playout in range(playouts):
+		if time.time() >= deadline:
+			break
+		index = playout % len(moves)
+		child = apply_move(board, moves[index])
+		# the opponent moves next, so we win when the player to move in <child> loses
+		if sum(child) == 0:
+			wins[index] += 0 if rules.misere else 1
+		elif not random_playout(child, rules):
+			wins[index] += 1
+		plays[index] += 1
+
+	played = [index for index in range(len(moves)) if plays[index] > 0] or [0]
+	best_index = max(played, key=lambda index: wins[index] / max(plays[index], 1))
+	return moves[best_index]
+
+
+# difficulty name -> (search function, depth or number of playouts)
+SEARCH_DIFFICULTIES = {
+	'easy': (monte_carlo_search, 200),
+	'medium': (depth_limited_search, 3),
+	'hard': (depth_limited_search, 8),
+}
+
+
+# entry point of a pool worker
+def run_search(difficulty, board, rules, deadline):
+	search, param = SEARCH_DIFFICULTIES[difficulty]
+	return search(board, rules, param, deadline)
+
+
+# strategy computed by a search. calling it searches inline, submit() runs it in a pool
+class SearchStrategy:
+	def __init__(self, difficulty, fallback, rules=None, budget=SEARCH_DEFAULT_BUDGET):
+		if difficulty not in SEARCH_DIFFICULTIES:
+			raise ValueError(f'unknown difficulty {difficulty}')
+		self.difficulty = difficulty
+		self.fallback = fallback       # cheap strategy played when the search misses its deadline
+		self.rules = rules or NimRules()
+		self.budget = budget           # seconds per move
+
+	def __call__(self, board):
+		return run_search(self.difficulty, board, self.rules, time.time() + self.budget * SEARCH_DEADLINE_MARGIN)
+
+	# submit a search for <board> to <executor>. return the future and the time.monotonic()
+	# deadline after which the server should stop waiting and play the fallback move. the
+	# worker's own deadline is compared in another process, so it stays on the wall clock
+	def submit(self, executor, board):
+		future = executor.submit(run_search, self.difficulty, board, self.rules, time.time() + self.budget * SEARCH_DEADLINE_MARGIN)
+		return future, time.monotonic() + self.budget
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import socket
+import struct
+import sys
+import time
+from collections import deque
+
+from nim_constants import *
+from nim_helper import *
+
+# > Session client
+#
+# Drives many games over a single connection to the server's session port. Every
+# packet carries the id of the game session it belongs to, responses of different
+# sessions are demultiplexed into per-session queues.
+
+
+class NimSessionClient:
+    def __init__(self, hostname, port):
+        self.hostname = hostname
+        self.port = port
+        self.soc = None
+        self.next_session_id = 1
+        self.responses = {}  # session id -> queue of (op, args) not consumed yet
+        self.resume_tokens = {}  # session id -> resume token of its game, from its OP_START
+        self.recv_buffer = b''
+
+    def connect(self):
+        self.soc = socket.create_connection((self.hostname, self.port))
+        self.soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        self.soc.close()
+
+    def send_packet(self, session_id, op, args=None, token=b''):
+        packet = encode_session_packet(session_id, encode_response(op, list(args or [])) + token)
+        self.soc.sendall(packet)
+
+    def new_session_id(self):
+        session_id = self.next_session_id
+        self.next_session_id = session_id % SESSION_ID_MAX + 1
+        self.responses[session_id] = deque()
+        return session_id
+
+    # open a new game session. the server answers it with OP_START, OP_WAIT or OP_REJECT
+    def open_session(self):
+        session_id = self.new_session_id()
+        self.send_packet(session_id, OP_SESSION_OPEN)
+        return session_id
+
+    # continue a game in a new session, from the game id and resume token of its OP_START. a game
+    # still played in another session is taken over from it. the server answers with OP_START, or
+    # OP_REJECT if there is no such game
+    def resume_session(self, token, game_id):
+        session_id = self.new_session_id()
+        self.send_packet(session_id, OP_RESUME, [game_id], token)
+        return session_id
+
+    def close_session(self, session_id):
+        self.send_packet(session_id, OP_SESSION_CLOSE)
+        self.responses.pop(session_id, None)
+        self.resume_tokens.pop(session_id, None)
+
+    def send_move(self, session_id, heap, num):
+        self.send_packet(session_id, OP_MOVE, [heap, num])
+
+    def send_game_state(self, session_id):
+        self.send_packet(session_id, OP_GAME_STATE)
+
+    # watch a game, or every game with NONE. a spectating connection can not open sessions
+    def spectate(self, game_id=NONE):
+        self.send_packet(0, OP_SPECTATE, [game_id])
+
+    # block until a packet arrives, return (session id, op, args)
+    def recv_packet(self):
+        while len(self.recv_buffer) < get_session_packet_size(self.recv_buffer):
+            chunk = self.soc.recv(4096)
+            if not chunk:
+                raise ConnectionError('server closed the connection')
+            self.recv_buffer += chunk
+        size = get_session_packet_size(self.recv_buffer)
+        session_id, op, *args = struct.unpack(SESSION_PACKET_STRUCT, self.recv_buffer[:SESSION_PACKET_SIZE])
+        if op == OP_START:
+            self.resume_tokens[session_id] = self.recv_buffer[SESSION_PACKET_SIZE:size]
+        self.recv_buffer = self.recv_buffer[size:]
+        return session_id, op, args
+
+    # return the next (op, args) of a session, queueing packets of other sessions meanwhile
+    def next_response(self, session_id):
+        while not self.responses[session_id]:
+            other_id, op, args = self.recv_packet()
+            if other_id in self.responses:
+                self.responses[other_id].append((op, args))
+        return self.responses[session_id].popleft()
+
+
+# play <games> concurrent games on one connection, always taking 1 from the largest heap.
+# return {op the game ended with: count}
+def play_games(client, games):
+    results = {}
+    for _ in range(games):
+        client.open_session()
+
+    open_sessions = games
+    while open_sessions > 0:
+        session_id, op, args = client.recv_packet()
+        if op in (OP_START, OP_MOVE_RESPONSE):
+            client.send_game_state(session_id)
+        elif op == OP_GAME_ACTIVE:
+            client.send_move(session_id, args.index(max(args)), 1)
+        elif op in (OP_GAME_DONE, OP_REJECT):
+            outcome = 'rejected' if op == OP_REJECT else ('won' if args[0] == ARG_CLIENT else 'lost')
+            results[outcome] = results.get(outcome, 0) + 1
+            if op == OP_GAME_DONE:
+                client.close_session(session_id)
+            open_sessions -= 1
+    return results
+
+
+# print the updates of the watched games as the server sends them
+def watch_games(client, game_id):
+    client.spectate(game_id)
+    while True:
+        game_id, op, args = client.recv_packet()
+        if op == OP_GAME_ACTIVE:
+            print(f'Game {game_id}: {args}')
+        elif op == OP_GAME_DONE:
+            print(f'Game {game_id}: {"client" if args[0] == ARG_CLIENT else "server"} won')
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) < 3 or not args[1].isdigit() or not (args[2].isdigit() or args[2].startswith('--spectate')):
+        exit('Usage: nim_session.py <hostname> <session-port> <games> | --spectate[=game-id]')
+
+    client = NimSessionClient(args[0], int(args[1]))
+    try:
+        client.connect()
+    except ConnectionRefusedError:
+        exit('Connection Refused')
+
+    try:
+        if args[2].startswith('--spectate'):
+            game_id = args[2].split('=', 1)[1] if '=' in args[2] else str(NONE)
+            watch_games(client, int(game_id))
+            return
+
+        start = time.time()
+        results = play_games(client, int(args[2]))
+        print(f'{results} in {time.time() - start:.2f}s')
+    except ConnectionError:
+        exit('Server closed the connection')
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import mmap
+import struct
+import sys
+from array import array
+
+from nim_constants import *
+
+# > Sprague-Grundy solver
+#
+# Grundy values and best-move tables are computed offline for every heap size up to
+# <max_heap> and written to a table file. The server memory-maps the file read-only,
+# so every worker process shares the same pages, and answers each move with a lookup
+# per heap instead of a search.
+#
+# table file layout (little-endian):
+#   header   : magic, version, flags, max heap, table width, subtraction set length
+#   set      : uint16 per allowed take (empty for unbounded nim)
+#   grundy   : uint16 per heap size 0..max_heap
+#   moves    : uint16 per (heap size, target grundy value) - smallest take reaching it, 0 if none
+
+SOLVER_TABLE_MAGIC = b'NIMG'
+SOLVER_TABLE_VERSION = 1
+SOLVER_TABLE_HEADER = "<4sBBHHH"
+SOLVER_FLAG_MISERE = 1
+
+
+# rules of the nim variant being played
+class NimRules:
+	def __init__(self, misere=False, subtraction_set=None):
+		if subtraction_set is not None:
+			subtraction_set = sorted(set(subtraction_set))
+			if 1 not in subtraction_set:
+				raise ValueError('subtraction set must contain 1 so every game can end')
+			if misere:
+				raise ValueError('misere play is only supported for unbounded nim')
+		self.misere = misere
+		self.subtraction_set = subtraction_set
+
+	# return True iff taking <num> items from a heap is allowed by the variant
+	def allows(self, num):
+		return self.subtraction_set is None or num in self.subtraction_set
+
+	# return the legal take amounts for a heap of size <heap>
+	def legal_takes(self, heap):
+		if self.subtraction_set is None:
+			return range(1, heap + 1)
+		return [take for take in self.subtraction_set if take <= heap]
+
+	def __eq__(self, other):
+		return isinstance(other, NimRules) and self.misere == other.misere and self.subtraction_set == other.subtraction_set
+
+
+# compute grundy values of heap sizes 0..max_heap under normal play
+def compute_grundy(rules, max_heap):
+	grundy = [0] * (max_heap + 1)
+	for heap in range(1, max_heap + 1):
+		reachable = {grundy[heap - take] for take in rules.legal_takes(heap)}
+		value = 0
+		while value in reachable:
+			value += 1
+		grundy[heap] = value
+	return grundy
+
+
+# build the table file contents for <rules> and heaps up to <max_heap>
+def build_table(rules, max_heap):
+	grundy = compute_grundy(rules, max_heap)
+	width = max(grundy) + 1
+	moves = array('H', bytes(2 * (max_heap + 1) * width))
+	for heap in range(max_heap + 1):
+		for take in rules.legal_takes(heap):
+			slot = heap * width + grundy[heap - take]
+			if moves[slot] == 0:
+				moves[slot] = take
+
+	subtraction_set = rules.subtraction_set or []
+	flags = SOLVER_FLAG_MISERE if rules.misere else 0
+	header = struct.pack(SOLVER_TABLE_HEADER, SOLVER_TABLE_MAGIC, SOLVER_TABLE_VERSION, flags,
+						 max_heap, width, len(subtraction_set))
+	body = [array('H', subtraction_set), array('H', grundy), moves]
+	if sys.byteorder != 'little':
+		for part in body:
+			part.byteswap()
+	return header + b''.join(part.tobytes() for part in body)
+
+
+def write_table(path, rules, max_heap):
+	with open(path, 'wb') as table_file:
+		table_file.write(build_table(rules, max_heap))
+
+
+# answers best-move queries from a precomputed table
+class NimSolver:
+	def __init__(self, table):
+		magic, version, flags, max_heap, width, set_len = struct.unpack_from(SOLVER_TABLE_HEADER, table)
+		if magic != SOLVER_TABLE_MAGIC or version != SOLVER_TABLE_VERSION:
+			raise ValueError('not a nim solver table')
+		if sys.byteorder != 'little':
+			raise ValueError('solver tables can only be mapped on little-endian hosts')
+
+		words = memoryview(table)[struct.calcsize(SOLVER_TABLE_HEADER):].cast('H')
+		self.table = table
+		self.max_heap = max_heap
+		self.width = width
+		self.rules = NimRules(bool(flags & SOLVER_FLAG_MISERE), list(words[:set_len]) if set_len else None)
+		self.grundy = words[set_len:set_len + max_heap + 1]
+		self.moves = words[set_len + max_heap + 1:]
+
+	# memory-map a table file. the mapping is read-only so it is shared between processes
+	@classmethod
+	def load(cls, path):
+		with open(path, 'rb') as table_file:
+			table = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+		return cls(table)
+
+	# smallest take from <heap> leaving a heap with grundy value <target>, 0 if none
+	def take_to(self, heap, target):
+		if target >= self.width:
+			return 0
+		return self.moves[heap * self.width + target]
+
+	# any legal move, used when the position is lost
+	def fallback_move(self, board):
+		heap_index = board.index(max(board))
+		return heap_index, self.rules.legal_takes(board[heap_index])[0]
+
+	# normal play: move to a position with grundy sum 0
+	def winning_move(self, board):
+		nim_sum = 0
+		for heap in board:
+			nim_sum ^= self.grundy[heap]
+		if nim_sum == 0:
+			return None
+		for index, heap in enumerate(board):
+			take = self.take_to(heap, self.grundy[heap] ^ nim_sum)
+			if take:
+				return index, take
+		return None
+
+	# misere nim: play as normal nim until the move would leave only heaps of size 0 or 1,
+	# then leave an odd number of heaps of size 1
+	def misere_move(self, board):
+		big_heaps = [index for index, heap in enumerate(board) if heap > 1]
+		ones = sum(1 for heap in board if heap == 1)
+		if len(big_heaps) == 1:
+			index = big_heaps[0]
+			return index, board[index] - (1 if ones % 2 == 0 else 0)
+		if len(big_heaps) == 0:
+			return None
+		return self.winning_move(board)
+
+	# return the server's move for <board> as (heap index, amount)
+	def best_move(self, board):
+		move = self.misere_move(board) if self.rules.misere else self.winning_move(board)
+		return move or self.fallback_move(board)
+
+
+def main():
+	args = sys.argv[1:]
+	if len(args) < 2 or not args[1].isdigit():
+		exit('Usage: nim_solver.py <table-path> <max-heap> [--misere] [--subtraction-set=1,2,3]')
+
+	misere = '--misere' in args
+	subtraction_set = None
+	for arg in args[2:]:
+		if arg.startswith('--subtraction-set='):
+			subtraction_set = [int(take) for take in arg.split('=', 1)[1].split(',')]
+		elif arg != '--misere':
+			exit('Invalid flags')
+
+	try:
+		rules = NimRules(misere, subtraction_set)
+	except ValueError as error:
+		exit(str(error))
+	write_table(args[0], rules, int(args[1]))
+
+
+if __name__ == "__main__":
+	main()
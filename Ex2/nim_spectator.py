@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict, deque
+
+from nim_constants import *
+
+# > Spectators
+#
+# Game updates are encoded once and the same bytes object is queued for every spectator
+# watching the game. A spectator keeps at most one pending update per game - a newer
+# update replaces the one not sent yet - and at most SPECTATOR_MAX_PENDING games, so a
+# slow spectator costs bounded memory and sees the latest board instead of a backlog.
+
+SPECTATOR_MAX_PENDING = 64      # games with an update waiting for a spectator before the oldest is dropped
+SPECTATOR_SEND_BATCH = 16       # updates handed to the socket per write
+
+
+class SpectatorQueue:
+	def __init__(self):
+		self.game_ids = set()          # watched games
+		self.watch_all = False         # watching every game
+		self.pending = OrderedDict()   # game id -> latest update not sent yet
+		self.in_flight = deque()       # updates (memoryviews) being written to the socket
+		self.coalesced = 0             # updates replaced by a newer one before being sent
+		self.dropped = 0               # updates dropped because too many games were pending
+
+	def subscribe(self, game_id):
+		if game_id == NONE:
+			self.watch_all = True
+		else:
+			self.game_ids.add(game_id)
+
+	def wants(self, game_id):
+		return self.watch_all or game_id in self.game_ids
+
+	def has_data(self):
+		return bool(self.in_flight or self.pending)
+
+	# queue a shared update of a game, replacing its update that was not sent yet
+	def push(self, game_id, packet):
+		if game_id in self.pending:
+			self.coalesced += 1
+			del self.pending[game_id]
+		elif len(self.pending) >= SPECTATOR_MAX_PENDING:
+			self.pending.popitem(last=False)
+			self.dropped += 1
+		self.pending[game_id] = packet
+
+	# write queued updates to soc without copying them. return bytes sent, or -1 upon failure
+	def send(self, soc):
+		while len(self.in_flight) < SPECTATOR_SEND_BATCH and self.pending:
+			self.in_flight.append(memoryview(self.pending.popitem(last=False)[1]))
+		try:
+			if hasattr(soc, 'sendmsg'):
+				sent = soc.sendmsg(self.in_flight)
+			else:
+				sent = soc.send(b''.join(self.in_flight))
+		except BlockingIOError:
+			return 0
+		except OSError:
+			return -1
+
+		# drop fully sent updates, keep the rest of a partially sent one
+		remaining = sent
+		while remaining > 0:
+			head = self.in_flight[0]
+			if remaining >= len(head):
+				remaining -= len(head)
+				self.in_flight.popleft()
+			else:
+				self.in_flight[0] = head[remaining:]
+				remaining = 0
+		return sent
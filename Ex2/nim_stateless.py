@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import hashlib
+import hmac
+import secrets
+import socket
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+from nim_constants import *
+from nim_helper import *
+
+# > Stateless games
+#
+# In stateless mode the server keeps no game between requests. Every response carries the
+# board and a state token signed with a key shared by all server instances; the client
+# echoes the token with its next request and any instance can verify it and continue.
+#
+# token layout: game id (u32), move sequence number (u16), board (3 x u16), turn (u8),
+# expiry time (u32), followed by a truncated HMAC-SHA256 of those fields.
+#
+# A token is consumed by the move made with it. Instances remember consumed (game id,
+# sequence number) pairs until the token expires, so a replayed token is refused by the
+# instance that saw it. Tokens expire after STATE_TOKEN_TTL seconds, which bounds how long
+# a token could be replayed against a different instance.
+#
+# The key is read from the file given with --stateless-key-file, written as hex text.
+
+STATE_TOKEN_BODY_STRUCT = ">IH3HBI"
+STATE_TOKEN_BODY_SIZE = struct.calcsize(STATE_TOKEN_BODY_STRUCT)
+STATE_TOKEN_TAG_SIZE = 16
+STATE_TOKEN_SIZE = STATE_TOKEN_BODY_SIZE + STATE_TOKEN_TAG_SIZE
+STATE_TOKEN_TTL = 300               # seconds a token stays valid
+STATE_KEY_MIN_SIZE = 16
+
+STATELESS_REQUEST_SIZE = PACKET_SIZE + STATE_TOKEN_SIZE          # packet followed by the token
+STATELESS_RESPONSE_STRUCT = ">6h"   # op, move validity, 3 heaps, turn (or winner when the game is done)
+STATELESS_RESPONSE_SIZE = struct.calcsize(STATELESS_RESPONSE_STRUCT) + STATE_TOKEN_SIZE
+
+REPLAY_CACHE_SIZE = 1000000         # consumed tokens remembered by an instance
+
+
+class InvalidStateToken(Exception):
+	def __init__(self, reason):
+		super().__init__(reason)
+		self.reason = reason        # ARG_TOKEN_* value sent to the client
+
+
+class StateTokenCodec:
+	def __init__(self, key, ttl=STATE_TOKEN_TTL):
+		if len(key) < STATE_KEY_MIN_SIZE:
+			raise ValueError(f'state token key should be at least {STATE_KEY_MIN_SIZE} bytes')
+		self.mac = hmac.new(key, digestmod=hashlib.sha256)  # keyed once, copied per token
+		self.ttl = ttl
+
+	def tag(self, body):
+		mac = self.mac.copy()
+		mac.update(body)
+		return mac.digest()[:STATE_TOKEN_TAG_SIZE]
+
+	def sign(self, game_id, seq, board, turn):
+		body = struct.pack(STATE_TOKEN_BODY_STRUCT, game_id, seq, *board, turn, int(time.time()) + self.ttl)
+		return body + self.tag(body)
+
+	# return (game id, seq, board, turn, expiry) of a valid token, raise InvalidStateToken otherwise
+	def verify(self, token):
+		body, tag = token[:STATE_TOKEN_BODY_SIZE], token[STATE_TOKEN_BODY_SIZE:]
+		if not hmac.compare_digest(tag, self.tag(body)):
+			raise InvalidStateToken(ARG_TOKEN_INVALID)
+		game_id, seq, *rest = struct.unpack(STATE_TOKEN_BODY_STRUCT, body)
+		board, turn, expiry = list(rest[:BOARD_SIZE]), rest[BOARD_SIZE], rest[BOARD_SIZE + 1]
+		if expiry < time.time():
+			raise InvalidStateToken(ARG_TOKEN_EXPIRED)
+		return game_id, seq, board, turn, expiry
+
+
+# consumed tokens of this instance, kept until they expire
+class ReplayCache:
+	def __init__(self, max_size=REPLAY_CACHE_SIZE):
+		self.max_size = max_size
+		self.consumed = OrderedDict()   # (game id, seq) -> expiry, in insertion (and so expiry) order
+
+	# mark a token consumed. return False if it already was
+	def consume(self, game_id, seq, expiry):
+		now = time.time()
+		while self.consumed and next(iter(self.consumed.values())) < now:
+			self.consumed.popitem(last=False)
+		if (game_id, seq) in self.consumed:
+			return False
+		if len(self.consumed) >= self.max_size:
+			self.consumed.popitem(last=False)
+		self.consumed[(game_id, seq)] = expiry
+		return True
+
+
+def new_game_id():
+	return secrets.randbits(32)
+
+
+def encode_stateless_response(op, validity, board, turn, token):
+	return struct.pack(STATELESS_RESPONSE_STRUCT, op, validity, *board, turn) + token
+
+
+def encode_stateless_request(op, args, token):
+	return encode_response(op, list(args)) + token
+
+
+# read a key shared by the server instances from a file holding it as hex text, such as the
+# output of `openssl rand -hex 32`. only the text is stripped, every key byte is kept
+def load_state_key(path):
+	with open(path, 'rb') as key_file:
+		text = key_file.read()
+	try:
+		return bytes.fromhex(text.decode('ascii').strip())
+	except ValueError:
+		raise ValueError('the key file should hold the key as hex text') from None
+
+
+# ------- Client ---------------------------------------
+
+def recv_exactly(soc, size):
+	data = b''
+	while len(data) < size:
+		chunk = soc.recv(size - len(data))
+		if not chunk:
+			raise ConnectionError('server closed the connection')
+		data += chunk
+	return data
+
+
+# send a request and return (op, validity, board, turn, token) of the response
+def stateless_request(soc, op, args, token):
+	soc.sendall(encode_stateless_request(op, args, token))
+	response = recv_exactly(soc, STATELESS_RESPONSE_SIZE)
+	op, validity, *rest = struct.unpack(STATELESS_RESPONSE_STRUCT, response[:-STATE_TOKEN_SIZE])
+	return op, validity, rest[:BOARD_SIZE], rest[BOARD_SIZE], response[-STATE_TOKEN_SIZE:]
+
+
+# play a game taking 1 from the largest heap, on a new connection for every move to show
+# that no instance keeps the game. return the winner
+def play_stateless_game(hostname, port):
+	token = bytes(STATE_TOKEN_SIZE)
+	op = OP_STATELESS_NEW
+	args = []
+	while True:
+		with socket.create_connection((hostname, port)) as soc:
+			op, validity, board, turn, token = stateless_request(soc, op, args, token)
+		if op == OP_GAME_DONE:
+			return turn
+		if op == OP_REJECT:
+			exit(f'Server refused the state token ({validity})')
+		op, args = OP_MOVE, [board.index(max(board)), 1]
+
+
+def main():
+	args = sys.argv[1:]
+	if len(args) < 2 or not args[1].isdigit():
+		exit('Usage: nim_stateless.py <hostname> <stateless-port>')
+	winner = play_stateless_game(args[0], int(args[1]))
+	print('You win!' if winner == ARG_CLIENT else 'Server win!')
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from nim_constants import *
+from nim_helper import *
+
+# > UDP transport
+#
+# Every datagram is one packet prefixed with a session id and a sequence number. The
+# client numbers its requests and retransmits a request, with exponential backoff, until
+# a response with the same sequence number arrives. The server answers a retransmitted
+# request from the response it cached instead of executing it again, so a lost response
+# never makes a move twice. A waiting client re-sends OP_SESSION_OPEN to poll for its start.
+
+UDP_HEADER_STRUCT = ">HH"           # session id, sequence number
+UDP_HEADER_SIZE = 4
+UDP_PACKET_STRUCT = ">HH4h"         # header followed by the packet structure
+UDP_PACKET_SIZE = UDP_HEADER_SIZE + PACKET_SIZE
+UDP_MAX_DATAGRAM_SIZE = UDP_PACKET_SIZE + RESUME_TOKEN_SIZE   # OP_START and OP_RESUME datagrams end with a resume token
+UDP_SEQ_MODULO = 65536
+
+UDP_SESSION_TIMEOUT = 30            # seconds a session may stay silent before the server drops it
+UDP_BATCH_MAX = 256                 # datagrams read per event loop iteration
+UDP_RETRANSMIT_INITIAL = 0.05       # seconds before the first retransmission
+UDP_RETRANSMIT_MAX = 1.0            # longest wait between retransmissions
+UDP_MAX_ATTEMPTS = 10               # transmissions of a request before giving up
+UDP_WAIT_POLL_INTERVAL = 0.2        # seconds between polls of a waiting client
+
+
+# a game session of a UDP client, identified by the client's address and session id
+class UdpSession:
+	def __init__(self, addr, session_id, seq):
+		self.addr = addr
+		self.session_id = session_id
+		self.seq = seq                 # sequence number of the last admission request
+		self.last_seen = time.monotonic()
+
+
+def encode_udp_packet(session_id, seq, packet_bytes):
+	return struct.pack(UDP_HEADER_STRUCT, session_id, seq) + packet_bytes
+
+
+# return True iff sequence number <seq> comes after <last_seq>, allowing wrap around
+def seq_after(seq, last_seq):
+	return last_seq is None or 0 < (seq - last_seq) % UDP_SEQ_MODULO < UDP_SEQ_MODULO // 2
+
+
+# ------- Client ---------------------------------------
+
+# socket wrapper dropping datagrams in both directions, for the loss harness
+class LossySocket:
+	def __init__(self, soc, loss, rng):
+		self.soc = soc
+		self.loss = loss
+		self.rng = rng
+
+	def sendto(self, data, addr):
+		if self.rng.random() >= self.loss:
+			self.soc.sendto(data, addr)
+
+	def recvfrom(self, size):
+		while True:
+			data, addr = self.soc.recvfrom(size)
+			if self.rng.random() >= self.loss:
+				return data, addr
+
+	def settimeout(self, timeout):
+		self.soc.settimeout(timeout)
+
+	def close(self):
+		self.soc.close()
+
+
+class NimUdpClient:
+	def __init__(self, hostname, port, session_id, soc=None):
+		self.addr = (hostname, port)
+		self.session_id = session_id
+		self.soc = soc or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.seq = random.randrange(UDP_SEQ_MODULO)
+		self.retransmissions = 0
+		self.game_id = None
+		self.resume_token = None       # token of the game being played, to resume it from another address
+
+	# send a request, followed by <token> if given, until its response arrives. return (op, args) of
+	# the response. an OP_START response also sets the game id and resume token
+	def request(self, op, args=None, polling=False, token=b''):
+		self.seq = (self.seq + 1) % UDP_SEQ_MODULO
+		datagram = encode_udp_packet(self.session_id, self.seq, encode_response(op, list(args or [])) + token)
+		timeout = UDP_RETRANSMIT_INITIAL
+		for attempt in range(UDP_MAX_ATTEMPTS):
+			if attempt > 0:
+				self.retransmissions += 1
+			self.soc.sendto(datagram, self.addr)
+			deadline = time.monotonic() + timeout
+			while time.monotonic() < deadline:
+				self.soc.settimeout(max(deadline - time.monotonic(), 0.001))
+				try:
+					data, _ = self.soc.recvfrom(UDP_MAX_DATAGRAM_SIZE)
+				except socket.timeout:
+					break
+				if len(data) < UDP_PACKET_SIZE:
+					continue
+				session_id, seq, resp_op, *resp_args = struct.unpack(UDP_PACKET_STRUCT, data[:UDP_PACKET_SIZE])
+				# while polling, a START sent on promotion answers an older poll
+				if session_id == self.session_id and (seq == self.seq or (polling and resp_op == OP_START)):
+					if resp_op == OP_START:
+						self.game_id, self.resume_token = resp_args[0], data[UDP_PACKET_SIZE:]
+					return resp_op, resp_args
+			timeout = min(timeout * 2, UDP_RETRANSMIT_MAX)
+		raise TimeoutError('server did not answer')
+
+	# open the session and wait until the game starts. return False if rejected
+	def open(self):
+		op, args = self.request(OP_SESSION_OPEN)
+		while op == OP_WAIT:
+			time.sleep(UDP_WAIT_POLL_INTERVAL)
+			op, args = self.request(OP_SESSION_OPEN, polling=True)
+		return op == OP_START
+
+	# continue a game, possibly from another address. a game still played in another session is
+	# taken over from it. return False if there is no such game
+	def resume(self, token, game_id):
+		op, args = self.request(OP_RESUME, [game_id], token=token)
+		return op == OP_START
+
+	def close(self):
+		self.request(OP_SESSION_CLOSE)
+
+
+# play one game taking 1 from the largest heap, checking that no move is applied twice
+# and that a move after the game ended is refused. return the winner, or None if the server rejected the session
+def play_udp_game(client):
+	if not client.open():
+		return None
+	op, board = client.request(OP_GAME_STATE)
+	while op == OP_GAME_ACTIVE:
+		heap = board.index(max(board))
+		op, args = client.request(OP_MOVE, [heap, 1])
+		assert op == OP_MOVE_RESPONSE and args[0] == ARG_MOVE_ACCEPTED, (op, args)
+		previous = board
+		op, board = client.request(OP_GAME_STATE)
+		if op == OP_GAME_ACTIVE:
+			# the client took 1 and the server took at least 1, exactly once each
+			assert board[heap] <= previous[heap] - 1 and sum(board) < sum(previous) - 1, (previous, board)
+	assert op == OP_GAME_DONE, op
+	# the session outlives its game, a late move is answered with the result
+	op, args = client.request(OP_MOVE, [0, 1])
+	assert op == OP_GAME_DONE and args[0] == board[0], (op, args)
+	client.close()
+	return board[0]
+
+
+# run <games> games over a lossy localhost link against a fresh server and report them.
+# return False if a game failed
+def run_loss_harness(games, loss):
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+		probe.bind(('', 0))
+		port = probe.getsockname()[1]
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nim-server.py')
+	server = subprocess.Popen([sys.executable, path, '10', '10', '10', '4', str(games), str(port + 1),
+							   f'--udp-port={port}'], stdout=subprocess.DEVNULL)
+	time.sleep(0.5)
+
+	clients = []
+	winners = [None] * games
+	failures = []                   # errors of the games, raised in their threads
+	start = time.time()
+
+	def play(index):
+		try:
+			winners[index] = play_udp_game(clients[index])
+		except Exception as error:
+			failures.append(f'game {index + 1}: {error!r}')
+
+	try:
+		for session_id in range(1, games + 1):
+			soc = LossySocket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), loss, random.Random(session_id))
+			clients.append(NimUdpClient('localhost', port, session_id, soc))
+		# the server admits 4 games at once, the other sessions wait and poll
+		threads = [threading.Thread(target=play, args=(index,)) for index in range(games)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		if server.poll() is not None:
+			failures.append(f'server exited with status {server.returncode}')
+	finally:
+		server.kill()
+		for client in clients:
+			client.soc.close()
+
+	print(f'{games} games at {loss:.0%} loss in {time.time() - start:.2f}s: '
+		  f'{winners.count(ARG_SERVER)} server wins, {winners.count(ARG_CLIENT)} client wins, '
+		  f'{sum(client.retransmissions for client in clients)} retransmissions')
+	for failure in failures:
+		print(f'[failed] {failure}')
+	return not failures
+
+
+def main():
+	args = sys.argv[1:]
+	if len(args) >= 1 and args[0] == '--harness':
+		games = int(args[1]) if len(args) > 1 else 20
+		loss = float(args[2]) if len(args) > 2 else 0.2
+		if not run_loss_harness(games, loss):
+			exit(1)
+		return
+
+	if len(args) < 2 or not args[1].isdigit():
+		exit('Usage: nim_udp.py <hostname> <udp-port> | --harness [games] [loss]')
+	winner = play_udp_game(NimUdpClient(args[0], int(args[1]), random.randrange(1, SESSION_ID_MAX + 1)))
+	if winner is None:
+		exit('You are rejected by the server.')
+	print('You win!' if winner == ARG_CLIENT else 'Server win!')
+
+
+if __name__ == "__main__":
+	main()